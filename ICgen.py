@@ -15,6 +15,7 @@ import pynbody
 SimArray = pynbody.array.SimArray
 import numpy as np
 import os
+import itertools
 import cPickle as pickle
 from warnings import warn
 
@@ -31,9 +32,15 @@ import make_sigma
 import sigma_profile
 from ICglobal_settings import global_settings
 import isaac
+import ICgen_utils
 
 # Initial stuff
 ICgenDir = os.path.dirname(os.path.realpath(__file__))
+# Attributes of IC objects which are saved by ICgen.save.  Changes to these 
+# are tracked so that only the ones which changed need to be saved
+_components = ('sigma', 'rho', 'pos', 'snapshot', 'snapshot_param', \
+'snapshot_director')
+_stamp_counter = itertools.count(1)
 
 class IC:
     """
@@ -73,6 +80,11 @@ class IC:
     
     def __init__(self, r=None, sigma=None, CDF=None, profile_kind=None, settings=None):
         
+        # Version stamps of the components and of what's been saved (see 
+        # ICgen.save)
+        self._stamps = {}
+        self._saved = {}
+        
         if isinstance(r,str):
             # Load the pickled sigma dictionary
             sig_dict = pickle.load(open(r,'r'))
@@ -115,13 +127,21 @@ class IC:
             self.maker.sigma_gen(r, sigma, CDF)
         
         # Define a saving function        
-        def saver(filename = None):
+        def saver(filename = None, force = False):
             """
             A wrapper for ICgen.save
             """
-            save(self, filename)
+            save(self, filename, force)
             
         self.save = saver
+    
+    def __setattr__(self, name, value):
+        
+        if name in _components:
+            # Give the component a new version stamp, so it gets saved
+            self._stamps[name] = next(_stamp_counter)
+        
+        self.__dict__[name] = value
         
     def Qest(self, r=None):
         """
@@ -203,13 +223,29 @@ def Qest(ICobj, r=None):
     return Q
         
         
-def save(ICobj, filename=None):
+def save(ICobj, filename=None, force=False):
+    """
+    Saves ICobj to filename (default settings.filenames.IC_file_name), 
+    along with its settings, and writes the snapshot, .param and .director
+    files if available.
     
+    Each component of ICobj (sigma, rho, pos, snapshot, ...) is saved to its
+    own file (see _component_file), which is only written if the component
+    has been changed (ie re-assigned, see IC.__setattr__) since it was last
+    saved there.  Changes made in place (eg to ICobj.pos.xyz) are not
+    tracked: use force=True to write everything.
+    """
     if filename is None:
         
         filename = ICobj.settings.filenames.IC_file_name
     
     save_dict = {}
+    # Save to a directory, one file per array (see ICgen_settings.filenames)
+    to_dir = (ICobj.settings.filenames.IC_format == 'dir')
+    
+    if to_dir and not os.path.isdir(filename):
+        
+        os.makedirs(filename)
     
     if hasattr(ICobj, '__version__'):
         
@@ -218,14 +254,73 @@ def save(ICobj, filename=None):
     # --------------------------------------------------
     # GET SETTINGS/save a copy
     # --------------------------------------------------
-    settings_name = os.path.splitext(filename)[0] + '_settings.p'
-    save_dict['settings'] = settings_name
+    if to_dir:
+        
+        settings_name = os.path.join(filename, 'settings.p')
+        # Stored relative to the directory, so it can be loaded from anywhere
+        save_dict['settings'] = 'settings.p'
+    
+    else:
+        
+        settings_name = os.path.splitext(filename)[0] + '_settings.p'
+        save_dict['settings'] = settings_name
+    
     ICobj.settings.save(settings_name)
     
     # --------------------------------------------------
-    # Prepare rho, if available
+    # Prepare/save the components
+    # --------------------------------------------------
+    components = [attr for attr in _components if hasattr(ICobj, attr)]
+    
+    for attr in components:
+        
+        # Save the component to its own file, if it has changed
+        target = _component_file(filename, attr, to_dir)
+        
+        if (not force) and _is_saved(ICobj, attr, target):
+            
+            continue
+        
+        entries = _save_entries(ICobj, attr, filename, to_dir, force)
+        
+        if to_dir:
+            # Write arrays to .npy files (named attr.key, eg sigma.CDF.npy),
+            # and everything else to target
+            for key in entries.keys():
+                
+                name = key if key == attr else '{0}.{1}'.format(attr, key)
+                entries[key] = ICgen_utils.arrays_to_files(entries[key], \
+                filename, name)
+        
+        pickle.dump(entries, open(target, 'wb'), protocol=2)
+        _mark_saved(ICobj, attr, target)
+    
+    # --------------------------------------------------
+    # SAVE
     # --------------------------------------------------
-    if hasattr(ICobj, 'rho'):
+    save_dict['components'] = components
+    
+    if to_dir:
+        
+        pickle.dump(save_dict, open(os.path.join(filename, 'meta.p'), 'wb'), \
+        protocol=2)
+    
+    else:
+        
+        pickle.dump(save_dict,open(filename,'wb'), protocol=2)
+    
+    print 'Initial conditions saved to {0}'.format(filename)        
+
+def _save_entries(ICobj, attr, filename, to_dir, force=False):
+    """
+    Prepares the entries of the save dictionary for the component attr of 
+    ICobj (see ICgen.save).  Files written alongside the IC file (the 
+    snapshot, .param and .director files) are written here, if they have 
+    changed since last saved
+    """
+    entries = {}
+    
+    if attr == 'rho':
         
         rho = ICobj.rho
         # Generate a dictionary containing rho_binned, z_bins, r_bins
@@ -233,72 +328,152 @@ def save(ICobj, filename=None):
         'rho': rho.rho_binned,\
         'z': rho.z_bins,\
         'r': rho.r_bins}
-        # Update save dictionary
-        save_dict['rho'] = rho_dict
+        
+        if ICobj.settings.rho_calc.save_tables:
+            # Save the inverse CDF and drho/dr tables, so they needn't be
+            # re-calculated on loading.  Named like the other files (eg
+            # rho.cdf_inv.npy or IC_rho_cdf_inv.npy), and stored relative to
+            # the IC (see _root_dir)
+            if to_dir:
+                
+                prefix = os.path.join(filename, 'rho.')
+            
+            else:
+                
+                prefix = os.path.splitext(filename)[0] + '_rho_'
+            
+            rho_dict['tables'] = rho.save_tables(prefix, \
+            _root_dir(filename, to_dir))
+        
+        entries['rho'] = rho_dict
     
-    # --------------------------------------------------
-    # Prepare sigma, if available
-    # --------------------------------------------------
-    if hasattr(ICobj, 'sigma'):
+    elif attr == 'sigma':
         
         sigma = ICobj.sigma
-        # Update save dictionary
-        save_dict['sigma'] = sigma.input_dict
-        save_dict['CDF'] = sigma._CDF
+        entries['sigma'] = sigma.input_dict
+        entries['CDF'] = sigma._CDF
 
-    # --------------------------------------------------
-    # Prepare pos if possible
-    # --------------------------------------------------
-    if hasattr(ICobj, 'pos'):
+    elif attr == 'pos':
         
-        save_dict['pos'] = ICobj.pos
+        if to_dir:
+            # Save the state rather than the object, so the arrays can be
+            # written to their own files
+            pos_state = ICobj.pos.__dict__.copy()
+            pos_state.pop('_parent', None)
+            entries['pos'] = pos_state
         
-    # --------------------------------------------------
-    # Prepare param/dict if possible
-    # --------------------------------------------------
-    if hasattr(ICobj, 'snapshot_param'):
+        else:
+            
+            entries['pos'] = ICobj.pos
         
-        save_dict['snapshot_param'] = ICobj.snapshot_param
-        param_name = ICobj.settings.filenames.paramName
-        isaac.configsave(ICobj.snapshot_param, param_name)
-        print 'param file saved to {0}'.format(param_name)
+    elif attr in ('snapshot_param', 'snapshot_director'):
         
-    if hasattr(ICobj, 'snapshot_director'):
+        entries[attr] = getattr(ICobj, attr)
         
-        save_dict['snapshot_director'] = ICobj.snapshot_director
-        director_name = ICobj.settings.filenames.directorName
-        isaac.configsave(ICobj.snapshot_director, director_name)
-        print 'director file saved to {0}'.format(director_name)
+        if attr == 'snapshot_param':
         
-    # --------------------------------------------------
-    # SAVE
-    # --------------------------------------------------
-    # Save snapshot if possible
-    if hasattr(ICobj, 'snapshot'):
+            fname = ICobj.settings.filenames.paramName
+        
+        else:
+            
+            fname = ICobj.settings.filenames.directorName
+        
+        if force or not _is_saved(ICobj, attr, fname):
+            
+            isaac.configsave(getattr(ICobj, attr), fname)
+            _mark_saved(ICobj, attr, fname)
+            print '{0} file saved to {1}'.format(attr.split('_')[1], fname)
+    
+    elif attr == 'snapshot':
         
         fmt = pynbody.tipsy.TipsySnap
         fname = ICobj.settings.filenames.snapshotName
-        save_dict['snapshotName'] = fname
+        entries['snapshotName'] = fname
         
-        # Sometimes, saving the snapshot once raises an error.  Saving again
-        # can fix this for some reason
+        if force or not _is_saved(ICobj, attr, fname):
         
-        try:
+            # Sometimes, saving the snapshot once raises an error.  Saving 
+            # again can fix this for some reason
+            try:
             
-            ICobj.snapshot.write(fmt = fmt, filename = fname)
+                ICobj.snapshot.write(fmt = fmt, filename = fname)
             
-        except ValueError:
+            except ValueError:
             
-            ICobj.snapshot.write(fmt = fmt, filename = fname)
+                ICobj.snapshot.write(fmt = fmt, filename = fname)
         
-    # Save the save dictionary
-    pickle.dump(save_dict,open(filename,'wb'), protocol=2)
-    print 'Initial conditions saved to {0}'.format(filename)        
+            _mark_saved(ICobj, attr, fname)
+    
+    return entries
+        
+def _component_file(filename, attr, to_dir):
+    """
+    Returns the file the component attr of an IC saved to filename is stored
+    in: filename/attr.p for IC_format = 'dir', otherwise <filename>_attr.p
+    (alongside filename, like the settings file)
+    """
+    if to_dir:
+        
+        return os.path.join(filename, attr + '.p')
+    
+    return os.path.splitext(filename)[0] + '_{0}.p'.format(attr)
+
+def _root_dir(filename, to_dir):
+    """
+    Returns the directory that files saved alongside an IC saved to filename
+    are stored relative to: filename itself for IC_format = 'dir', otherwise
+    the directory containing filename
+    """
+    if to_dir:
+        
+        return filename
+    
+    return os.path.dirname(filename) or os.curdir
+
+def _is_saved(ICobj, attr, target):
+    """
+    Checks whether the current version of ICobj.attr has already been saved
+    to the file target
+    """
+    target = os.path.abspath(target)
+    stamp = ICobj._stamps.get(attr)
+    
+    return (stamp is not None) and (ICobj._saved.get(target) == stamp) \
+    and os.path.exists(target)
+
+def _mark_saved(ICobj, attr, target):
+    """
+    Records that the current version of ICobj.attr is saved in target
+    """
+    ICobj._saved[os.path.abspath(target)] = ICobj._stamps.get(attr)
     
 def load(filename):
        
     # Load everything available from filename
-    input_dict = pickle.load(open(filename,'rb'))
+    to_dir = os.path.isdir(filename)
+    
+    if to_dir:
+        # Saved with IC_format = 'dir'.  Arrays are loaded as memory maps
+        input_dict = pickle.load(open(os.path.join(filename, 'meta.p'), 'rb'))
+        # The settings file is stored relative to the directory
+        input_dict['settings'] = os.path.join(filename, input_dict['settings'])
+    
+    else:
+        
+        input_dict = pickle.load(open(filename,'rb'))
+    
+    # Components are saved to their own files.  (Older ICs have everything
+    # in filename)
+    components = input_dict.pop('components', [])
+    
+    for attr in components:
+        
+        fname = _component_file(filename, attr, to_dir)
+        input_dict.update(pickle.load(open(fname, 'rb')))
+    
+    if to_dir:
+        
+        input_dict = ICgen_utils.files_to_arrays(input_dict, filename)
     
     # Get version/update IC if necessary
     if 'version' in input_dict:
@@ -342,12 +517,20 @@ def load(filename):
     if 'rho' in input_dict:
         
         print 'loading rho'
-        ICobj.add.rho(input_dict['rho'])
+        ICobj.add.rho(input_dict['rho'], _root_dir(filename, to_dir))
         
     if 'pos' in input_dict:
         
         print 'loading pos'
-        ICobj.pos = input_dict['pos']
+        pos = input_dict['pos']
+        
+        if isinstance(pos, dict):
+            # Saved as a state dictionary (IC_format = 'dir')
+            state = pos
+            pos = pos_class.pos(ICobj, generate=False)
+            pos.__dict__.update(state)
+        
+        ICobj.pos = pos
         ICobj.pos._parent = ICobj
         
     if 'snapshotName' in input_dict:
@@ -372,6 +555,24 @@ def load(filename):
             
             warn('Could not find snapshot ({0})'.format(fname))
             print 'Could not find snapshot ({0})'.format(fname)
+    
+    # Everything loaded is already saved, so needn't be saved again unless
+    # it changes
+    filenames = ICobj.settings.filenames
+    
+    for attr, fname in (('snapshot', input_dict.get('snapshotName')), \
+    ('snapshot_param', filenames.paramName), \
+    ('snapshot_director', filenames.directorName)):
+        
+        if hasattr(ICobj, attr):
+            
+            _mark_saved(ICobj, attr, fname)
+    
+    for attr in components:
+        
+        if hasattr(ICobj, attr):
+            
+            _mark_saved(ICobj, attr, _component_file(filename, attr, to_dir))
         
     
 
@@ -433,7 +634,7 @@ class add:
         
         self._parent = ICobj
         
-    def rho(self,rho_dict):
+    def rho(self, rho_dict, root=None):
         """
         Generates a rho object and stores it in ICobj.rho
         
@@ -441,6 +642,10 @@ class add:
             'z':    1D array of z values
             'r':    1D array of r values
             'rho':  2D array of rho evaluated at z,r
+            'tables': (optional) saved inverse CDF and drho/dr tables.  See
+                calc_rho_zr.rho_from_array.save_tables
+        
+        root (optional) is the directory the table filenames are relative to
             
         Exaple:
         
@@ -454,6 +659,10 @@ class add:
         
         self._parent.rho = calc_rho_zr.rho_from_array(self._parent, rho_binned, z_bins, r_bins)
         
+        if 'tables' in rho_dict:
+            # Pre-calculated tables (see ICgen.save)
+            self._parent.rho.load_tables(rho_dict['tables'], root)
+        
         print 'rho stored in <IC instance>.rho'
         
 
@@ -516,9 +725,12 @@ class maker:
             
         # Numerically calculate rho(z,r) for a given sigma.  rho(z,r)
         # obeys vertical hydrostatic equilibrium (approximately)
-        rho_array, z, r = calc_rho_zr.rho_zr(self._parent)
+        rho_array, z, r, info = calc_rho_zr.rho_zr(self._parent, \
+        full_output=True)
         # Create a complete rho object.  Includes rho spline and CDF inverse
         rho = calc_rho_zr.rho_from_array(self._parent, rho_array, z, r)
+        # Iteration counts and final residuals of the solver at each radius
+        rho.solver_info = info
         # Save to ICobj
         self._parent.rho = rho
         
@@ -75,6 +75,11 @@ class filenames:
 
         # Initial conditions filename
         self.IC_file_name = 'IC.p'
+        # Format to save initial conditions in.  'pickle' saves IC_file_name
+        # plus one pickle per component alongside it (eg IC_pos.p).  'dir'
+        # makes IC_file_name a directory with one .npy file per array
+        # (loaded as memory maps) and the rest in meta.p and <component>.p
+        self.IC_format = 'pickle'
         # Filename to save tipsy snapshot to
         self.snapshotName = 'snapshot.std'
         # Filename to save ChaNGa .param file to.  If None, no file saved
@@ -258,6 +263,64 @@ class rho_calc:
         # Numerical parameter.  During the calculation of rho(z) for a given r.  See
         # the doc-string for calc_rho.py
         self.rho_tol = 1.001
+        # If True, solve for rho(z) at all radii simultaneously as a single
+        # block system (see calc_rho.rho_zr_block) rather than one radius at
+        # a time
+        self.vectorized = False
+        # Root finder used by calc_rho.rho_z for each radius.  'krylov' uses
+        # scipy's newton_krylov, 'newton' uses Newton's method with explicit
+        # sparse jacobians (faster)
+        self.solver = 'krylov'
+        # If True, radii are split into contiguous chunks (one per process)
+        # and each radius is started from the solution at the previous radius
+        # (rescaled by the scale height).  Works best with solver = 'newton'.
+        # Ignored if vectorized = True
+        self.warm_start = False
+        # Radial grid to calculate rho(z,r) on.  'linear' (uniform) or
+        # 'adaptive' (concentrates points where sigma(r) and T(r) change
+        # fastest.  See calc_rho_zr.radial_grid)
+        self.r_grid = 'linear'
+        # If not None, each radius gets its own z grid, linspace(0, zmax(r), nz),
+        # extending to scale_z times the local scale height (but not past 
+        # zmax).  ~6 works well and allows a much smaller nz.  See
+        # calc_rho_zr.z_extent
+        self.scale_z = None
+        # Directory for an on-disk cache of rho(z) solutions (see rho_cache.py)
+        # If None, no cache is used.  Only radii whose inputs changed since
+        # the last run are re-calculated
+        self.cache_dir = None
+        # Maximum size of the cache in MB.  The least recently used solutions
+        # are deleted first.  If None, the cache size is not limited
+        self.cache_size = 100
+        # Number of worker processes used to calculate rho(z,r).  If None,
+        # the number of cpus is used.  The pool is re-used between calls.
+        # If distributed = True, this is the number of processes per node
+        self.n_proc = None
+        # Number of radii sent to a worker at a time.  If None, chosen so
+        # that each process gets ~4 chunks.  Ignored if warm_start = True
+        self.chunksize = None
+        # If True, spread the calculation over all the nodes in 
+        # global_settings['node_info']['nodelist'] (eg, from PBS_NODEFILE).
+        # See cluster_pool.py.  Ignored if vectorized = True
+        self.distributed = False
+        # Level for logging the rho calculation (see calc_rho_zr.set_log_level)
+        # 'DEBUG' logs every radius and iteration, 'INFO' a summary table
+        self.log_level = 'INFO'
+        # If not None, skip the numerical solve for rho(z) at radii where the
+        # star or self-gravity dominates and use the (semi-)analytic limit.
+        # The ratio of the scale heights in the two limits must be below
+        # analytic_tol.  With the default nz, 0.1 changes rho by ~5e-7 of
+        # its peak (<1e-4 at any one radius).  On coarse z grids (nz ~ 100)
+        # the thin inner disc is under-resolved and the analytic rho there
+        # can differ from the numerical one by a few percent, whatever the
+        # tol.  See calc_rho._analytic_limit
+        self.analytic_tol = None
+        # Number of points in the CDF (m) grid used to tabulate the inverse CDF
+        # of rho(z) at every r (see calc_rho_zr.rho_from_array.cdf_inv)
+        self.nm = 2000
+        # If True, ICgen.save also saves the inverse CDF and drho/dr tables 
+        # (as .npy files) so that loading doesn't have to re-calculate them
+        self.save_tables = False
 
         
     def __call__(self):
@@ -286,8 +349,18 @@ class pos_gen:
         
         # Number of random positions to generate:
         self.nParticles = 40411
-        # The method for generating positions
+        # The method for generating positions: 'grid', 'random', or 'qmc' 
+        # (quasi-random, see pos_class.pos)
         self.method = 'grid'
+        # Number of positions to generate at a time.  Smaller chunks use less
+        # memory.  If None, all are generated at once
+        self.chunksize = None
+        # If not None, xyz is stored in a memory map to this file (useful for
+        # very large numbers of particles)
+        self.xyz_file = None
+        # Number of processes to generate the chunks with.  The positions
+        # don't depend on n_proc
+        self.n_proc = 1
         
     def __call__(self):
         
@@ -499,3 +572,25 @@ class settings:
             self.physical.__dict__.update(tmp_dict['physical'].__dict__)
             # update the version
             self.__version__ = 3
+            
+        # Settings may have been added since these were saved.  Fill in any
+        # that are missing with their defaults
+        self._fill_defaults()
+        
+    def _fill_defaults(self):
+        """
+        Adds any settings which are missing (ie, settings which were added
+        to ICgen since these settings were saved), using the defaults
+        """
+        defaults = {'filenames': filenames, 'rho_calc': rho_calc, \
+        'pos_gen': pos_gen, 'snapshot': snapshot, 'changa_run': changa_run}
+        
+        for key, cls in defaults.iteritems():
+            
+            new_settings = cls()
+            
+            if key in self.__dict__:
+                
+                new_settings.__dict__.update(self.__dict__[key].__dict__)
+                
+            self.__dict__[key] = new_settings
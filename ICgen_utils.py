@@ -91,6 +91,213 @@ class larray(list):
         
         return delistify(self)
 
+def bin_groups(ind, nbins=None):
+    """
+    Groups the elements of an array by bin, sorting once rather than 
+    scanning the whole array for every bin (ie, mask = (ind == i)).
+    
+    **ARGUMENTS**
+    
+    ind : array_like
+        Integer bin index of every element (eg, from numpy.digitize).  
+        Elements with ind < 0 or ind >= nbins are ignored
+    nbins : int
+        (optional) Number of bins.  Defaults to ind.max() + 1
+    
+    **RETURNS**
+    
+    order : array
+        Indices which sort ind (stable, so elements in a bin stay in their
+        original order).  Elements outside of the bins are dropped
+    bounds : array
+        Length nbins + 1.  The elements in bin i are:
+            order[bounds[i]:bounds[i+1]]
+    
+    USAGE:
+        
+        order, bounds = bin_groups(ind, nbins)
+        
+        for i in range(nbins):
+            
+            x_i = x[order[bounds[i]:bounds[i+1]]]
+    """
+    ind = np.asarray(ind)
+    
+    if nbins is None:
+        
+        nbins = ind.max() + 1
+    
+    order = np.argsort(ind, kind='mergesort')
+    ind_sorted = ind[order]
+    # Positions in the sorted array where each bin starts
+    bounds = np.searchsorted(ind_sorted, np.arange(nbins + 1))
+    order = order[bounds[0]:bounds[-1]]
+    bounds -= bounds[0]
+    
+    return order, bounds
+
+def halton(index, base, stream=None):
+    """
+    Returns the Halton sequence (the radical inverse of index in base, a 
+    prime) at the integer indices index.  Halton sequences in different 
+    prime bases make a low-discrepancy (quasi-random) sequence of points, 
+    which fill space much more evenly than random points.
+    
+    **ARGUMENTS**
+    
+    index : array_like
+        Integer indices of the points (>= 0)
+    base : int
+        Base (a prime, eg 2, 3, 5 for 3 dimensions)
+    stream : RandomState
+        (optional) If given, the sequence is scrambled with a random 
+        permutation of the digits at every digit position (drawn from stream).
+        This removes the correlations between bases while keeping the low
+        discrepancy.  The scrambling depends only on the state of stream, 
+        so any set of indices can be calculated separately (eg in chunks)
+    
+    **RETURNS**
+    
+    x : array
+        Points in [0, 1]
+    """
+    index = np.array(index, dtype=np.int64)
+    # Number of digits to resolve a double
+    n_digits = int(np.ceil(53 * np.log(2)/np.log(base)))
+    
+    if stream is not None:
+        
+        perms = [stream.permutation(base) for j in range(n_digits)]
+    
+    x = np.zeros(index.shape)
+    scale = 1.0
+    
+    for j in range(n_digits):
+        
+        scale /= base
+        
+        if not index.any():
+            
+            if stream is not None:
+                # Every remaining digit is 0, ie a constant once scrambled
+                x += sum([perms[k][0] * float(base)**-(k + 1) \
+                for k in range(j, n_digits)])
+            
+            break
+        
+        digit = index % base
+        index //= base
+        
+        if stream is not None:
+            
+            digit = perms[j][digit]
+        
+        x += digit * scale
+    
+    # Round off can give slightly more than 1
+    return np.minimum(x, 1.0)
+
+class array_file:
+    """
+    A reference to an array saved as a .npy file (see 
+    ICgen_utils.arrays_to_files).  Stores the filename (relative to the 
+    directory it was saved in) and units of the array
+    
+    USAGE:
+        
+        array = array_file.load(dirname)
+    """
+    
+    def __init__(self, filename, units=None):
+        
+        self.filename = filename
+        self.units = units
+    
+    def load(self, dirname, mmap_mode='c'):
+        """
+        Loads the array from dirname as a memory map (no copy is made).  
+        mmap_mode is passed to numpy.load.  The default, 'c' (copy-on-write),
+        allows the array to be changed in memory without changing the file
+        """
+        array = np.load(os.path.join(dirname, self.filename), \
+        mmap_mode=mmap_mode)
+        
+        if self.units is not None:
+            
+            array = array.view(SimArray)
+            array.units = self.units
+        
+        return array
+
+def arrays_to_files(obj, dirname, name=None):
+    """
+    Saves every array in obj to its own .npy file in dirname and replaces it
+    with an array_file reference, so that obj can be pickled without the 
+    arrays.  Arrays are written straight to disk (not pickled) and can be 
+    loaded back as memory maps (see ICgen_utils.files_to_arrays)
+    
+    **ARGUMENTS**
+    
+    obj : array, dict, or anything else
+        An array or a dict (searched recursively).  Anything else is 
+        returned unchanged
+    dirname : str
+        Directory to save to.  Must already exist
+    name : str
+        (optional) Filename (without .npy) for obj.  Arrays in dicts are 
+        named by their key, ie name.key.npy
+    
+    **RETURNS**
+    
+    obj with the arrays replaced by array_file objects
+    """
+    if isinstance(obj, np.ndarray):
+        
+        fname = name + '.npy'
+        units = obj.units if isinstance(obj, SimArray) else None
+        # Write to a temporary file then rename, in case the file being
+        # replaced is memory mapped
+        path = os.path.join(dirname, fname)
+        tmpname = path + '.tmp'
+        
+        with open(tmpname, 'wb') as f:
+            
+            np.save(f, np.asarray(obj))
+        
+        os.rename(tmpname, path)
+        
+        return array_file(fname, units)
+    
+    if isinstance(obj, dict):
+        
+        out = {}
+        
+        for key, val in obj.iteritems():
+            
+            key_name = key if name is None else '{0}.{1}'.format(name, key)
+            out[key] = arrays_to_files(val, dirname, key_name)
+        
+        return out
+    
+    return obj
+
+def files_to_arrays(obj, dirname, mmap_mode='c'):
+    """
+    Reverses arrays_to_files.  Replaces all array_file objects in obj 
+    (searched recursively through dicts) with the arrays loaded from dirname
+    as memory maps.  See array_file.load
+    """
+    if isinstance(obj, array_file):
+        
+        return obj.load(dirname, mmap_mode)
+    
+    if isinstance(obj, dict):
+        
+        return dict([(key, files_to_arrays(val, dirname, mmap_mode)) \
+        for key, val in obj.iteritems()])
+    
+    return obj
+
 def listify(array, max_element=10**7):
     """
     Breaks up an array or SimArray into chunks and saves as an larray object
@@ -40,6 +40,8 @@ defaults['misc'] = misc
 # ***** Cluster presets *****
 node_info = {}
 node_info['scheduler'] = 'PBS'
+# How to start workers on other nodes (see cluster_pool.py).  'ssh' or 'local'
+node_info['launcher'] = 'ssh'
 defaults['node_info'] = node_info
 
 # ***** ChaNGa presets *****
@@ -185,7 +187,7 @@ class settings(dict):
             
         else:
             # Assume there's no scheduler
-            return [node_info['hostname']]
+            nodelist = [node_info['hostname']]
         
         node_info['nodelist'] = nodelist
         secondary_nodes = set(node_info['nodelist'])
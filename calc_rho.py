@@ -18,12 +18,22 @@ import scipy.integrate as nInt
 import scipy.optimize as opt
 from scipy.interpolate import interp1d
 from scipy.optimize.nonlin import NoConvergence
+import scipy.sparse as sparse
+from scipy.sparse.linalg import spsolve
 import pynbody
 from pynbody.array import SimArray
 from warnings import warn
 import sys
+import time
+import logging
 
-def rho_z(sigma, T, r, settings):
+# Messages go to the 'ICgen' logger.  Per-radius parameters, iterations and
+# timings are logged at DEBUG, non-convergence at WARNING.  To see them, 
+# see calc_rho_zr.set_log_level (or configure logging directly)
+logger = logging.getLogger('ICgen.calc_rho')
+logging.getLogger('ICgen').addHandler(logging.NullHandler())
+
+def rho_z(sigma, T, r, settings, full_output=False, rho_guess=None, zmax=None):
     """ 
     rho,z = rho_z(...)
     
@@ -56,6 +66,12 @@ def rho_z(sigma, T, r, settings):
         Steps 5-7 are done because the solution for I does not seem to
         satisfy the diff. eq. for rho very well.  But doing it this way 
         allows rho to satisfy the surface density profile
+        
+    The root finding is set by settings.rho_calc.solver:
+        'krylov' : scipy's newton_krylov (no jacobian), as described above
+        'newton' : Newton's method with explicit sparse jacobians and direct
+            sparse solves.  The normalization of rho is included in the 
+            system for rho, so steps 6-7 are not needed.  Usually much faster
     
     * Arguments *
     
@@ -67,15 +83,42 @@ def rho_z(sigma, T, r, settings):
     
     settings - ICobj settings (ie, ICobj.settings)
         
+    full_output - If True, also return a dictionary of solver info
+    
+    rho_guess - (optional) The output of rho_z (with full_output=True) at a
+    neighbouring radius.  If supplied, the initial guess is that solution,
+    with z rescaled by the ratio of the scale heights and rho renormalized. 
+    This skips steps 1-2 (the scan for the erf length scale) and usually
+    most of the iterations.  See settings.rho_calc.warm_start
+    
+    zmax - (optional) maximum z to calculate rho at.  If None, 
+    settings.rho_calc.zmax is used.  See settings.rho_calc.scale_z
+    
     * Output *
     Returns a 1D SimArray (see pynbody) of rho(z) and a 1D SimArray of z,
     with the same units as ICobj.settings.rho_calc.zmax
     
+    If full_output is True, also returns a dictionary containing:
+        'niter' : number of iterations
+        'residual' : final residual of the diff. eq. for rho (normalized by
+            max(rho))
+        'converged' : True if the solution converged
+        'h' : estimated scale height (in units of zmax, see _scale_height), 
+            used for rescaling rho_guess
+        'r' : r (in units of zmax)
+        'time' : time taken (in s)
+        'method' : how rho was found.  The solver used ('newton' or 
+            'krylov'), 'star' or 'self-gravity' (analytic limits, see 
+            _analytic_limit) or 'empty' (rho = 0)
     """
     # Parse settings
     rho_tol = settings.rho_calc.rho_tol
     nz = settings.rho_calc.nz
-    zmax = settings.rho_calc.zmax
+    solver = settings.rho_calc.solver
+    
+    if zmax is None:
+        
+        zmax = settings.rho_calc.zmax
     
     m = settings.physical.m
     M = settings.physical.M
@@ -99,26 +142,19 @@ def rho_z(sigma, T, r, settings):
     z = np.linspace(0.0,zmax,nz)
     dz = z[[1]]-z[[0]]
     
+    t_start = time.time()
+    
     # Echo parameters used
-    print '***********************************************'
-    print '* Calculating rho(z)'
-    print '***********************************************'
-    print 'sigma          = {0} {1}'.format(sigma,sigma.units)
-    print 'zmax           = {0} {1}'.format(zmax,zmax.units)
-    print 'r              = {0} {1}'.format(r,r.units)
-    print 'molecular mass = {0} {1}'.format(m,m.units)
-    print 'Star mass      = {0} {1}'.format(M,M.units)
-    print 'Temperature    = {0} {1}'.format(T,T.units)
-    print ''
-    print 'rho_tol        = {0}'.format(rho_tol)
-    print 'nz             = {0}'.format(nz)
-    print '***********************************************'
-    print 'a              = {0} {1}'.format(a,a.units)
-    print 'b              = {0} {1}'.format(b,b.units)
-    print 'z0guess        = {0} {1}'.format(z0guess,z0guess.units)
-    print '***********************************************'
-    
-    print 'z0 (from sech^2) = {0} {1}'.format(z0_dummy,z0_dummy.units)
+    if logger.isEnabledFor(logging.DEBUG):
+    
+        logger.debug('Calculating rho(z) at r = %s %s: sigma = %s %s, '
+        'T = %s %s, zmax = %s %s, nz = %d, rho_tol = %s', float(r), r.units, \
+        float(sigma), sigma.units, float(T), T.units, float(zmax), \
+        zmax.units, nz, rho_tol)
+        logger.debug('a = %s %s, b = %s %s, z0guess = %s %s, '
+        'z0 (from sech^2) = %s %s', float(a), a.units, float(b), b.units, \
+        float(z0guess), z0guess.units, float(z0_dummy), z0_dummy.units)
+    
     # --------------------------------------------------------
     # STRIP THE UNITS FROM EVERYTHING!!!
     # This has to be done because many of the scipy/numpy functions used cannot
@@ -140,6 +176,11 @@ def rho_z(sigma, T, r, settings):
         rho0 = isaac.set_units(rho0, mass_unit/length_unit**3)
         z = isaac.set_units(z, length_unit)
         
+        if full_output:
+            
+            return rho0, z, {'niter': 0, 'residual': 0.0, 'converged': True, \
+            'time': 0.0, 'method': 'empty'}
+            
         return rho0, z
         
     if T > 1e100:
@@ -150,83 +191,28 @@ def rho_z(sigma, T, r, settings):
         rho0 = isaac.set_units(rho0, mass_unit/length_unit**3)
         z = isaac.set_units(z, length_unit)
         
+        if full_output:
+            
+            return rho0, z, {'niter': 0, 'residual': 0.0, 'converged': True, \
+            'time': 0.0, 'method': 'empty'}
+            
         return rho0, z  
         
     # -------------------------------------------------------------------
     # FUNCTION DEFINITIONS
     # -------------------------------------------------------------------
-    def dI_dz(I_in):
-        """
-        Finite difference approximation of dI/dz, assuming I is odd around I(0)
-        """
-        I = I_in.copy()
-        dI = np.zeros(len(I))
-        # Fourth order center differencing
-        dI[0] = (-I[2] + 8*I[1] - 7*I[0])/(6*dz)
-        dI[1] = (-I[3] + 8*I[2] - 6*I[0] - I[1])/(12*dz)
-        dI[2:-2] = (-I[4:] + 8*I[3:-1] -8*I[1:-3] + I[0:-4])/(12*dz)
-        # Second order backward differencing for right edge
-        dI[-2:] = (3*I[-2:] -4*I[-3:-1] + I[-4:-2])/(2*dz)
-        
-        return dI
-        
-    def d2I_dz2(I_in):
-        
-        # Finite difference for d2I/dz2 assuming it is 0 at the origin
-        I = I_in.copy()
-        d2I = np.zeros(len(I))
-        # Boundary condition
-        d2I[0] = 0
-        # Centered 4th order finite difference
-        d2I[1] = (-I[3] + 16*I[2] - 30*I[1] + 16*I[0] -(2*I[0] - I[1]))/(12*dz**2)
-        d2I[2:-2] = (-I[4:] + 16*I[3:-1] - 30*I[2:-2] + 16*I[1:-3] - I[0:-4])/(12*(dz**2))
-        # second order backward difference for right edge
-        d2I[-2:] = (-2*I[-2:] + 5*I[-3:-1] -4*I[-4:-2] + I[-5:-3])/dz**2
-        
-        return d2I
-        
     def Ires(I_in):
         """
         Calculate the residual for the differential equation governing I,
         the integral of rho from z to "infinity."
         """
-        # DEFINE INITIAL CONDITION:
-        I = I_in.copy()
-        I[0] = rho_int
-        #I[-1] = 0.0
-        weight = 1.0
-
-        res = d2I_dz2(I) + dI_dz(I)*(a*z/((z**2 + r**2)**(1.5)) + 2*b*(I[0] - I))
-        
-        return weight*res
-        
-    def drho_dz(rho_in):
-        """
-        Fourth order, centered finite difference for d(rho)/dz, assumes that
-        rho is an even function.  The right-hand boundary is done using
-        backward differencing
-        """
-        rho = rho_in.copy()
-        drho = np.zeros(len(rho))
-        drho[0] = 0.0   # defined by boundary condition, rho[0] = max(rho)
-        drho[1] = (-rho[3] + 8*rho[2] - 8*rho[0] + rho[1])/(12*dz)
-        drho[2:-2] = (-rho[4:] + 8*rho[3:-1] - 8*rho[1:-3] + rho[0:-4])/(12*dz)
-        drho[-2:] = (3*rho[-2:] - 4*rho[-3:-1] + rho[-4:-2])/(2*dz)
-        
-        return drho
+        return I_residual(I_in, z, dz, r, a, b, rho_int)
         
     def residual(rho_in):
         """
         Estimate d(rho)/dz
         """
-        rho = rho_in.copy()
-        # Estimate integral of rho
-        I = np.zeros(len(rho))
-        I[1:] = nInt.cumtrapz(rho,z)
-        # Estimate residual 
-        res = drho_dz(rho) + a*rho*z/((z**2 + r**2)**(1.5)) + 2*b*rho*I
-        
-        return res
+        return rho_residual(rho_in, z, dz, r, a, b)
         
     def erf_res(scale_size):
         
@@ -241,16 +227,234 @@ def rho_z(sigma, T, r, settings):
     # -------------------------------------------------------------------
     
     maxiter = 40
+    limit = _analytic_limit(z0guess, b, rho_int, \
+    settings.rho_calc.analytic_tol)
+    
+    if limit is not None:
+        # One limit dominates.  Skip the numerical solve
+        rho0 = _analytic_rho(z, r, a, b, rho_int, limit)
+        solver = limit
+        info = {'niter': 0, 'converged': True, \
+        'residual': float(abs(residual(rho0)).max()/rho0.max())}
+    
+    elif _can_warm_start(rho_guess):
+        # Start from the solution at a neighbouring radius
+        h = _scale_height(z0guess, b, rho_int)
+        guess = _rescale_guess(rho_guess, z, h, rho_int, length_unit)
+        logger.debug('Initial guess from r = %s %s', rho_guess[2]['r'], \
+        length_unit)
+        
+    else:
+        # Estimate the scale length of the error function
+        z0 = opt.fminbound(erf_res,z0guess/100.0,5.0*z0guess)
+        logger.debug('Length scale guess: %s %s, final length scale: %s %s', \
+        float(z0guess), length_unit, float(z0), length_unit)
+        
+        # Begin by finding I, the integral of rho (from z to inf)
+        # Assuming rho is gaussian, I is an error function
+        guess = rho_int*(1 - scipy.special.erf(z/z0))
+        
+    if limit is None:
+        
+        if solver == 'newton':
+    
+            rho0, info = _rho_z_newton(guess, z, dz, r, a, b, rho_int, \
+            rho_tol, maxiter)
+        
+        elif solver == 'krylov':
+        
+            rho0, info = _rho_z_krylov(guess, Ires, residual, z, dz, \
+            rho_int, rho_tol, maxiter)
+        
+        else:
+        
+            raise ValueError, \
+            'Unrecognized rho_calc.solver {0}'.format(solver)
+        
+    info['h'] = float(_scale_height(z0guess, b, rho_int))
+    info['r'] = float(r)
+    info['time'] = time.time() - t_start
+    info['method'] = solver
+    logger.debug('r = %s %s: solver %s, %d iterations, residual = %.3g, '
+    '%.3f s', info['r'], length_unit, solver, info['niter'], \
+    info['residual'], info['time'])
+        
+    if not info['converged']:
+        
+        logger.warning('Solution to rho did not converge for r = %s %s', \
+        info['r'], length_unit)
+        
+    
+    # Re-introduce units
+    rho0 = isaac.set_units(rho0, mass_unit/length_unit**3)
+    z = isaac.set_units(z, length_unit)
+    
+    if full_output:
+        
+        return SimArray(rho0,'Msol au**-3'), SimArray(z,'au'), info
+        
+    return SimArray(rho0,'Msol au**-3'), SimArray(z,'au')
+    
+def scale_height(sigma, T, r, settings):
+    """
+    Estimates the scale height h (defined by rho(z=0) = sigma/(2*h)) of the
+    disc at radius r without solving for rho(z).  See _scale_height
+    
+    * Arguments *
+    
+    sigma, T, r - Surface density, temperature, and radius (SimArrays)
+    
+    settings - ICobj settings (ie, ICobj.settings)
+    
+    * Output *
+    
+    Returns h, a SimArray in au
+    """
+    m = settings.physical.m
+    M = settings.physical.M
+    kB = SimArray(1.0,'k')
+    G = SimArray(1.0,'G')
+    
+    rho_int = (0.5*sigma).in_units('Msol au**-2')
+    a = (G*M*m/(kB*T)).in_units('au')
+    b = (2*np.pi*G*m/(kB*T)).in_units('au Msol**-1')
+    z0guess = np.sqrt(2*r*r*r/a).in_units('au')
+    rho_int, a, b, z0guess = [np.asarray(x, dtype=float) \
+    for x in (rho_int, a, b, z0guess)]
+    
+    return SimArray(_scale_height(z0guess, b, rho_int), 'au')
+    
+def _scale_height(z0guess, b, rho_int):
+    """
+    Estimates the scale height (rho_int/rho(z=0)) of the disc by combining,
+    in quadrature, the scale heights for the limits where the star dominates
+    (gaussian rho, z0guess = sqrt(2*r**3/a)) and where self-gravity 
+    dominates (sech^2 rho, z0 = 1/(b*rho_int)).  The actual scale height
+    is ~0.85-1 times this.  Inputs should be unitless
+    """
+    h_star = 0.5*np.sqrt(np.pi)*z0guess
+    
+    # Empty columns (rho_int = 0) have h_self = inf, ie h = h_star
+    with np.errstate(divide='ignore'):
+        
+        h_self = 1.0/(b*rho_int)
+    
+    return 1.0/np.sqrt(h_star**-2 + h_self**-2)
+
+def _analytic_limit(z0guess, b, rho_int, tol):
+    """
+    Checks whether rho(z) can be found analytically.  The ratio of the star
+    and self-gravity scale heights (see _scale_height), eps = h_star/h_self,
+    measures how much self-gravity matters.  Returns 'star' if eps < tol,
+    'self-gravity' if 1/eps < tol, otherwise None.  Inputs should be
+    unitless.  Arrays are handled element-wise, returning an array of
+    strings ('' where neither limit applies).  If tol is None, returns None
+    without checking
+    """
+    if tol is None:
+        
+        return None
+    
+    h_star = 0.5*np.sqrt(np.pi)*z0guess
+    
+    # Empty columns (rho_int = 0) give eps = 0, ie the 'star' limit.  Bad
+    # columns (eg r = 0) give eps = nan, ie no limit
+    with np.errstate(divide='ignore', invalid='ignore'):
+        
+        h_self = 1.0/(b*rho_int)
+        eps = np.atleast_1d(h_star/h_self)
+        limit = np.array([''] * len(eps), dtype='|S12')
+        limit[eps < tol] = 'star'
+        limit[1.0/eps < tol] = 'self-gravity'
+    
+    if len(limit) == 1:
+        
+        return None if limit[0] == '' else limit[0]
+    
+    return limit
+
+def _analytic_rho(z, r, a, b, rho_int, limit, n_corr=2):
+    """
+    Semi-analytic rho(z) in the limits where the star or self-gravity 
+    dominates (limit = 'star' or 'self-gravity').  Inputs should be 
+    unitless.  z can be 2D (nz, nr), with r, a, b, rho_int one per column.
     
-    # Estimate the scale length of the error function
-    z0 = opt.fminbound(erf_res,z0guess/100.0,5.0*z0guess)
-    print 'Length scale guess: {0} {1}'.format(z0guess, length_unit)
-    print 'Final length scale: {0} {1}'.format(z0, length_unit)
+    'star': rho ~ exp(a*(1/sqrt(z**2 + r**2) - 1/r)), the exact solution 
+    without self-gravity.  Self-gravity is then included with n_corr 
+    fixed-point corrections, rho -> rho * exp(-2*b*int(I dz)), where I is
+    the integral of rho from 0 to z.  Each correction reduces the error by 
+    a factor ~eps/2 (see _analytic_limit)
     
-    # Begin by finding I, the integral of rho (from z to inf)
-    # Assuming rho is gaussian, I is an error function
-    guess = rho_int*(1 - scipy.special.erf(z/z0))
+    'self-gravity': rho ~ sech(z/z0)**2, with z0 = 1/(b*rho_int)
     
+    rho is normalized so that its integral from 0 to zmax is rho_int
+    """
+    if limit == 'star':
+        
+        shape = np.exp(a*(1.0/np.sqrt(z**2 + r**2) - 1.0/r))
+        rho = shape * rho_int/nInt.trapz(shape, z, axis=0)
+        
+        for i in range(n_corr):
+            
+            I = np.zeros(z.shape)
+            I[1:] = nInt.cumtrapz(rho, z, axis=0)
+            J = np.zeros(z.shape)
+            J[1:] = nInt.cumtrapz(I, z, axis=0)
+            rho = shape * np.exp(-2*b*J)
+            rho *= rho_int/nInt.trapz(rho, z, axis=0)
+    
+    elif limit == 'self-gravity':
+        
+        z0 = 1.0/(b*rho_int)
+        rho = np.cosh(z/z0)**-2
+        rho *= rho_int/nInt.trapz(rho, z, axis=0)
+    
+    else:
+        
+        raise ValueError, 'Unrecognized limit {0}'.format(limit)
+    
+    return rho
+    
+def _can_warm_start(rho_guess):
+    """
+    Checks whether rho_guess (the output of rho_z at another radius, see 
+    rho_z) can be used as an initial guess
+    """
+    if rho_guess is None:
+        
+        return False
+        
+    rho_prev, z_prev, info_prev = rho_guess
+    
+    return ('h' in info_prev) and info_prev['converged'] \
+    and (rho_prev.max() > 0)
+    
+def _rescale_guess(rho_guess, z, h, rho_int, length_unit):
+    """
+    Generates an initial guess for I (the integral of rho from z to inf) from
+    the solution at another radius.  rho_guess = (rho, z, info) is the output 
+    of rho_z (with full_output=True).  z is stretched by the ratio of the 
+    scale heights (see _scale_height) and rho is normalized to integrate to 
+    rho_int.  z, h, and rho_int should be unitless
+    """
+    rho_prev, z_prev, info_prev = rho_guess
+    rho_prev = isaac.strip_units(rho_prev)
+    z_prev = isaac.strip_units(z_prev.in_units(length_unit))
+    
+    scale = float(h)/info_prev['h']
+    rho0 = np.interp(z/scale, z_prev, rho_prev, right=0.0)
+    I = np.zeros(len(z))
+    I[1:] = nInt.cumtrapz(rho0, z)
+    
+    return rho_int*(1 - I/I[-1])
+    
+def _rho_z_krylov(guess, Ires, residual, z, dz, rho_int, rho_tol, maxiter):
+    """
+    Finds rho(z) for rho_z using scipy's newton_krylov solver (no jacobian)
+    and repeated rescaling of rho.  See rho_z, steps 3-7.  
+    
+    Returns rho, info
+    """
     # Find the root of the differential equation for I
     f_tol = rho_int * 6e-6
     try:
@@ -265,12 +469,12 @@ def rho_z(sigma, T, r, settings):
         Isol = xepshun[1][0]
         
     # rho is the negative derivative
-    rho0 = -dI_dz(Isol)
+    rho0 = -dI_dz(Isol, dz)
     
     # Now apply the diff eq on rho
     for n in range(maxiter):
         
-        print 'Iteration {0}'.format(n+1)
+        logger.debug('Iteration %d', n+1)
         f_tol = rho0.max() * 6e-6
         try:
             
@@ -284,24 +488,565 @@ def rho_z(sigma, T, r, settings):
             rho0 = xepshun[1][0]
             
         rho_scale = rho_int/nInt.cumtrapz(rho0,z)[-1]
-        print 'Scaling rho by {0}'.format(rho_scale)
+        logger.debug('Scaling rho by %s', rho_scale)
         rho0 = rho0*rho_scale
         
         if abs(1-rho_scale) < rho_tol - 1:
             
             break
+            
+    info = {'niter': n + 1, \
+    'residual': float(abs(residual(rho0)).max()/rho0.max()), \
+    'converged': bool(abs(1-rho_scale) < rho_tol - 1)}
+    
+    return rho0, info
+    
+def _rho_z_newton(guess, z, dz, r, a, b, rho_int, rho_tol, maxiter):
+    """
+    Finds rho(z) for rho_z using Newton's method with an explicit sparse 
+    jacobian and direct sparse solves.  
+    
+    rho = -dI/dz (with I = guess) is used as the initial guess.  The 
+    normalization of rho (integral of rho = rho_int) is included in the 
+    system for rho, so rho does not need to be rescaled.
+    
+    Returns rho, info
+    """
+    f_tol = 6e-6
+    nz = len(z)
+    dz, r, a, b, rho_int = [float(np.squeeze(x)) for x in (dz, r, a, b, rho_int)]
+    g = a*z/((z**2 + r**2)**(1.5))
+    
+    rho0 = -dI_dz(guess, dz)
+    rho_max = rho0.max()
+    # I is carried as an unknown (see rho_system)
+    I = np.zeros(nz)
+    I[1:] = nInt.cumtrapz(rho0, z)
+    x = np.concatenate([rho0*rho_int/I[-1], I*rho_int/I[-1]])
+    
+    def rho_fcn(x):
+        
+        return rho_system(x, z, dz, g, b, rho_int, rho_max)
+        
+    def rho_jac(x):
+        
+        return rho_jacobian(x, z, dz, g, b, rho_int, rho_max)
+        
+    def rho_linear(x):
+        
+        return rho_jacobian(x, z, dz, g, b, rho_int, rho_max, full=False)
+        
+    # Far from the solution, full Newton steps can wander off.  Begin with
+    # the diff. eq. linearized with I held fixed (a fixed point iteration), 
+    # then switch to Newton
+    F = rho_fcn(x)
+    n_lin = 0
+    
+    while (abs(F).max() > 1e-3) and (n_lin < maxiter):
+        
+        x = x + spsolve(rho_linear(x), -F)
+        F = rho_fcn(x)
+        n_lin += 1
+        
+    x, n_rho, res = _sparse_newton(rho_fcn, rho_jac, x, f_tol, \
+    maxiter - n_lin, rho_linear)
+    rho0 = x[0:nz]
+    
+    rho_scale = rho_int/nInt.cumtrapz(rho0, z)[-1]
+    info = {'niter': n_lin + n_rho, 'residual': float(res), \
+    'converged': bool((res <= f_tol) & (abs(1 - rho_scale) < rho_tol - 1))}
+    
+    return rho0, info
+    
+def _sparse_newton(fcn, jac, x0, f_tol, maxiter, fallback=None):
+    """
+    Newton's method for a 1D system with a sparse jacobian.  Steps are
+    found by direct sparse solves.  If a step does not reduce the residual
+    (max norm), the step is halved (up to 5 times).  If that fails and fallback is given,
+    a step using the matrix fallback(x) in place of the jacobian is taken.
+    
+    Iterates until the residual (max norm) is below f_tol.
+    
+    Returns x, niter, residual
+    """
+    x = x0.copy()
+    F = fcn(x)
+    res = abs(F).max()
+    n = 0
+    
+    while (res > f_tol) and (n < maxiter):
+        
+        n += 1
+        dx = spsolve(jac(x).tocsc(), -F)
+        step = 1.0
+        res_new = np.inf
+        
+        for i in range(6):
+            
+            if not np.all(np.isfinite(dx)):
+                # Singular jacobian
+                break
+            
+            x_new = x + step*dx
+            F_new = fcn(x_new)
+            res_new = abs(F_new).max()
+            
+            if res_new < res:
+                
+                break
+            
+            step *= 0.5
+            
+        if not (res_new < res) and (fallback is not None):
+            
+            x_new = x + spsolve(fallback(x).tocsc(), -F)
+            F_new = fcn(x_new)
+            res_new = abs(F_new).max()
+            
+        if not (res_new < res):
+            # Could not improve the solution
+            break
+        
+        x = x_new
+        F = F_new
+        res = res_new
         
-    if n >= maxiter:
+    return x, n, res
+    
+
+def rho_zr_block(sigma, T, r, settings, full_output=False, zmax=None):
+    """
+    rho,z = rho_zr_block(...)
+    
+    Calculates rho(z) at all radii r simultaneously.  This solves the same
+    equations as rho_z (see rho_z for a description of the method), but
+    rather than doing one nonlinear solve per radius, the whole (nz, nr) grid
+    is solved as a single block system.  The finite difference stencils are
+    applied along axis 0 of the 2D arrays, so every radius is handled in the
+    same numpy operations.
+    
+    The erf length scale estimate (done with fminbound in rho_z) is done for
+    all radii at once with a vectorized golden section search.
+    
+    * Arguments *
+    
+    sigma - The surface density at r.  1D SimArray
+    
+    T - The temperature at r.  1D SimArray
+    
+    r - The radii at which rho is being calculated.  1D SimArray
+    
+    settings - ICobj settings (ie, ICobj.settings)
+    
+    full_output - If True, also return a dictionary of solver info
+    
+    zmax - (optional) 1D SimArray of the maximum z at each radius.  If None,
+    settings.rho_calc.zmax is used at all radii
+    
+    * Output *
+    Returns a 2D SimArray rho(z,r) of shape (nz, nr) and a 1D SimArray of z.
+    If zmax is supplied, z is a 2D SimArray of shape (nz, nr)
+    
+    If full_output is True, also returns a dictionary of solver info (see
+    rho_z), with one entry per radius in each array
+    """
+    # Parse settings
+    rho_tol = settings.rho_calc.rho_tol
+    nz = settings.rho_calc.nz
+    
+    if zmax is None:
         
-        print 'Warning: solution to rho did not converge for r = {0}'.format(r)
+        zmax = settings.rho_calc.zmax
+        z = np.linspace(0.0,zmax,nz)
+        
+    else:
+        
+        z = np.linspace(0.0,1.0,nz)[:,None]*zmax[None,:]
+    
+    m = settings.physical.m
+    M = settings.physical.M
+    
+    # Physical constants
+    kB = SimArray(1.0,'k')
+    G = SimArray(1.0,'G')
+    
+    # Set up default units
+    mass_unit = M.units
+    length_unit = zmax.units
+    r = (r.in_units(length_unit)).copy()
+    sigma = sigma.in_units(mass_unit/length_unit**2)
+    
+    # Initial conditions/physical parameters
+    rho_int = 0.5*sigma   # Integral of rho from 0 to inf
+    a = (G*M*m/(kB*T)).in_units(length_unit)
+    b = (2*np.pi*G*m/(kB*T)).in_units(length_unit/mass_unit)
+    z0guess = np.sqrt(2*r*r*r/a).in_units(length_unit)# Est. scale height of disk
+    z = z.in_units(length_unit)
+    
+    t_start = time.time()
+    logger.info('Calculating rho(z) for %d radii as a single block', len(r))
+    
+    # Strip units (see rho_z)
+    rho_int, a, b, z0guess, r, T, sigma, z = [np.asarray(x, dtype=float) \
+    for x in (rho_int, a, b, z0guess, r, T, sigma, z)]
+    
+    nr = len(r)
+    # The block solver works with z for every radius
+    z_block = z if z.ndim == 2 else np.repeat(z[:,None], nr, 1)
+    dz = z_block[1] - z_block[0]
+    rho = np.zeros([nz, nr])
+    
+    # --------------------------------------------------------
+    # Check sigma and T
+    # --------------------------------------------------------
+    solve = (sigma >= 1e-100) & (T <= 1e100)
+    
+    if not np.all(solve):
+        
+        warn('Sigma too small or temperature too large at {0} radii.  '\
+        'Setting rho = 0 there'.format((~solve).sum()))
+    
+    info = {'niter': np.zeros(nr, dtype=int), 'residual': np.zeros(nr), \
+    'converged': np.ones(nr, dtype=bool), 'method': np.array(['empty'] * nr, \
+    dtype='|S12')}
+    # Radii where rho can be found analytically
+    limit = _analytic_limit(z0guess, b, rho_int, \
+    settings.rho_calc.analytic_tol)
+    
+    for kind in ('star', 'self-gravity'):
+        
+        use = solve & (limit == kind)
+        
+        if np.any(use):
+            
+            rho[:, use] = _analytic_rho(z_block[:,use], r[use], a[use], \
+            b[use], rho_int[use], kind)
+            info['residual'][use] = abs(rho_residual(rho[:,use], \
+            z_block[:,use], dz[use], r[use], a[use], b[use])).max(0) \
+            / rho[:,use].max(0)
+            info['method'][use] = kind
+            solve = solve & ~use
+    
+    if np.any(solve):
+        
+        rho[:, solve], niter, res, converged = _solve_block(z_block[:,solve], \
+        dz[solve], r[solve], a[solve], b[solve], rho_int[solve], \
+        z0guess[solve], rho_tol)
+        info['niter'][solve] = niter
+        info['residual'][solve] = res
+        info['converged'][solve] = converged
+        info['method'][solve] = 'block'
+    
+    # The radii are solved together, so share out the time evenly
+    info['time'] = np.ones(nr) * (time.time() - t_start)/nr
     
     # Re-introduce units
-    rho0 = isaac.set_units(rho0, mass_unit/length_unit**3)
+    rho = isaac.set_units(rho, mass_unit/length_unit**3)
     z = isaac.set_units(z, length_unit)
     
-    return SimArray(rho0,'Msol au**-3'), SimArray(z,'au')
+    if full_output:
+        
+        return SimArray(rho,'Msol au**-3'), SimArray(z,'au'), info
+        
+    return SimArray(rho,'Msol au**-3'), SimArray(z,'au')
+    
+def _solve_block(z, dz, r, a, b, rho_int, z0guess, rho_tol):
+    """
+    Solves for rho(z) at all radii simultaneously (see rho_zr_block).  All
+    inputs should be unitless.  z should be 2D, shape (nz, len(r)), ie the
+    z grid for each radius.  dz, r, a, b, rho_int, and z0guess should be 1D
+    arrays with one entry per radius.  
+    
+    Returns rho, niter, residual, converged.  rho is a 2D array, shape
+    (nz, len(r)).  The others are 1D arrays with one entry per radius
+    
+    The diff. eq. for rho is:
+    
+        drho/dz + (g + 2*b*I)*rho = 0
+        
+    where I is the integral of rho from 0 to z and g is the gravitational
+    acceleration term from the star.  This is solved by fixed point iteration:
+    holding I fixed, the equation is linear in rho.  The linear system 
+    (using the drho_dz stencil, with the first row replaced by the
+    normalization of rho) is solved for all radii at once as one sparse,
+    block diagonal system.  I is then re-calculated from the new rho.
+    At convergence, rho_residual is zero.
+    """
+    maxiter = 40
+    f_tol = 6e-6
+    nz = len(z)
+    ncol = len(r)
+    # Gravitational acceleration term from the star
+    g = a*z/((z**2 + r**2)**(1.5))
+    
+    def erf_res(scale_size):
+        
+        testfct = rho_int*(1 - scipy.special.erf(z/scale_size))
+        
+        return abs(I_residual(testfct, z, dz, r, a, b, rho_int)).sum(0)
+        
+    # Estimate the scale length of the error function at all radii using a
+    # golden section search over the same interval used by rho_z
+    z0 = _golden_min(erf_res, z0guess/100.0, 5.0*z0guess)
+    
+    # Initial guess.  If I is an error function, rho is a gaussian
+    rho0 = np.exp(-(z/z0)**2)
+    I = np.zeros(rho0.shape)
+    I[1:] = nInt.cumtrapz(rho0, z, axis=0)
+    rho0 *= rho_int/I[-1]
+    I *= rho_int/I[-1]
+    
+    # Set up the parts of the linear system which do not change.  The first
+    # row for every radius is the normalization: trapz(rho) = rho_int
+    eq_rows = np.ones([nz, ncol])
+    eq_rows[0] = 0
+    w = dz*np.ones([nz, ncol])
+    w[[0,-1]] *= 0.5
+    
+    niter = np.zeros(ncol, dtype=int)
+    res = np.zeros(ncol)
+    active = np.arange(ncol)
+    
+    for n in range(maxiter):
+        
+        cols = active
+        nact = len(cols)
+        D1 = _block_stencil(drho_dz, nz, nact)
+        norm_rows = np.repeat(nz*np.arange(nact), nz)
+        N = sparse.csr_matrix((w[:,cols].ravel(order='F'), (norm_rows, \
+        np.arange(nz*nact))), shape=(nz*nact, nz*nact))
+        h = eq_rows[:,cols]*(g[:,cols] + 2*b[cols]*I[:,cols])
+        A = sparse.diags((eq_rows[:,cols]/dz[cols]).ravel(order='F'), 0) * D1 \
+        + sparse.diags(h.ravel(order='F'), 0) + N
+        rhs = np.zeros([nz, nact])
+        rhs[0] = rho_int[cols]
+        
+        rho_new = spsolve(A.tocsc(), rhs.ravel(order='F'))
+        rho0[:,cols] = rho_new.reshape([nz, nact], order='F')
+        I[1:,cols] = nInt.cumtrapz(rho0[:,cols], z[:,cols], axis=0)
+        niter[cols] += 1
+        
+        res[cols] = abs(rho_residual(rho0[:,cols], z[:,cols], dz[cols], \
+        r[cols], a[cols], b[cols])).max(0)/rho0[:,cols].max(0)
+        active = cols[res[cols] > f_tol]
+        
+        if len(active) == 0:
+            
+            break
+        
+    logger.debug('Block solve: %d iterations (max over all radii)', \
+    niter.max())
+    
+    # Check the BC on I (normalization of rho)
+    rho_scale = rho_int/I[-1]
+    not_converged = (res > f_tol) | (abs(1 - rho_scale) >= rho_tol - 1)
+    
+    if np.any(not_converged):
+        
+        logger.warning('Solution to rho did not converge for %d radii', \
+        not_converged.sum())
+        
+    return rho0, niter, res, ~not_converged
+    
+def _golden_min(fcn, x_lo, x_hi, n_iter=40):
+    """
+    Vectorized golden section search.  Minimizes fcn(x) independently for
+    every element of x, bounded by the arrays x_lo and x_hi.  fcn should
+    take an array of x and return an array of the same shape.
+    """
+    g = 0.5*(np.sqrt(5.0) - 1)
+    x_lo = np.array(x_lo, dtype=float)
+    x_hi = np.array(x_hi, dtype=float)
+    x1 = x_hi - g*(x_hi - x_lo)
+    x2 = x_lo + g*(x_hi - x_lo)
+    f1 = fcn(x1)
+    f2 = fcn(x2)
+    
+    for i in range(n_iter):
+        
+        # Where f1 < f2 the minimum lies in [x_lo, x2]
+        left = f1 < f2
+        right = ~left
+        x_hi[left] = x2[left]
+        x_lo[right] = x1[right]
+        x2[left] = x1[left]
+        f2[left] = f1[left]
+        x1[right] = x2[right]
+        f1[right] = f2[right]
+        # New interior points
+        x1[left] = x_hi[left] - g*(x_hi[left] - x_lo[left])
+        x2[right] = x_lo[right] + g*(x_hi[right] - x_lo[right])
+        f_new = fcn(np.where(left, x1, x2))
+        f1[left] = f_new[left]
+        f2[right] = f_new[right]
+        
+    return 0.5*(x_lo + x_hi)
+    
+# -------------------------------------------------------------------
+# FINITE DIFFERENCE STENCILS AND RESIDUALS
+# These operate along axis 0, so they work on 1D arrays (a single radius)
+# or on 2D arrays of shape (nz, nr) (all radii at once).  For 2D arrays,
+# z should be shaped (nz, 1) and r, a, b, rho_int should be 1D (length nr)
+# so that they broadcast
+# -------------------------------------------------------------------
+def dI_dz(I_in, dz):
+    """
+    Finite difference approximation of dI/dz, assuming I is odd around I(0)
+    """
+    I = I_in.copy()
+    dI = np.zeros(I.shape)
+    # Fourth order center differencing
+    dI[0] = (-I[2] + 8*I[1] - 7*I[0])/(6*dz)
+    dI[1] = (-I[3] + 8*I[2] - 6*I[0] - I[1])/(12*dz)
+    dI[2:-2] = (-I[4:] + 8*I[3:-1] -8*I[1:-3] + I[0:-4])/(12*dz)
+    # Second order backward differencing for right edge
+    dI[-2:] = (3*I[-2:] -4*I[-3:-1] + I[-4:-2])/(2*dz)
+    
+    return dI
+    
+def d2I_dz2(I_in, dz):
+    
+    # Finite difference for d2I/dz2 assuming it is 0 at the origin
+    I = I_in.copy()
+    d2I = np.zeros(I.shape)
+    # Boundary condition
+    d2I[0] = 0
+    # Centered 4th order finite difference
+    d2I[1] = (-I[3] + 16*I[2] - 30*I[1] + 16*I[0] -(2*I[0] - I[1]))/(12*dz**2)
+    d2I[2:-2] = (-I[4:] + 16*I[3:-1] - 30*I[2:-2] + 16*I[1:-3] - I[0:-4])/(12*(dz**2))
+    # second order backward difference for right edge
+    d2I[-2:] = (-2*I[-2:] + 5*I[-3:-1] -4*I[-4:-2] + I[-5:-3])/dz**2
+    
+    return d2I
+    
+def drho_dz(rho_in, dz):
+    """
+    Fourth order, centered finite difference for d(rho)/dz, assumes that
+    rho is an even function.  The right-hand boundary is done using
+    backward differencing
+    """
+    rho = rho_in.copy()
+    drho = np.zeros(rho.shape)
+    drho[0] = 0.0   # defined by boundary condition, rho[0] = max(rho)
+    drho[1] = (-rho[3] + 8*rho[2] - 8*rho[0] + rho[1])/(12*dz)
+    drho[2:-2] = (-rho[4:] + 8*rho[3:-1] - 8*rho[1:-3] + rho[0:-4])/(12*dz)
+    drho[-2:] = (3*rho[-2:] - 4*rho[-3:-1] + rho[-4:-2])/(2*dz)
     
+    return drho
+    
+def I_residual(I_in, z, dz, r, a, b, rho_int):
+    """
+    Calculate the residual for the differential equation governing I,
+    the integral of rho from z to "infinity."
+    """
+    # DEFINE INITIAL CONDITION:
+    I = I_in.copy()
+    I[0] = rho_int
+    #I[-1] = 0.0
+    weight = 1.0
+
+    res = d2I_dz2(I, dz) + dI_dz(I, dz)*(a*z/((z**2 + r**2)**(1.5)) + 2*b*(I[0] - I))
+    
+    return weight*res
+    
+def rho_residual(rho_in, z, dz, r, a, b):
+    """
+    Residual for the differential equation governing rho
+    """
+    rho = rho_in.copy()
+    # Estimate integral of rho
+    I = np.zeros(rho.shape)
+    I[1:] = nInt.cumtrapz(rho, z, axis=0)
+    # Estimate residual 
+    res = drho_dz(rho, dz) + a*rho*z/((z**2 + r**2)**(1.5)) + 2*b*rho*I
+    
+    return res
+    
+# -------------------------------------------------------------------
+# SPARSE STENCIL MATRICES
+# The matrices are for the flattened (order='F', ie column by column)
+# system.  They are generated by applying the stencils to the identity matrix
+# -------------------------------------------------------------------
+_stencil_matrices = {}
 
+def _block_stencil(stencil, nz, ncol):
+    """
+    Returns the sparse, block diagonal matrix for applying stencil (with
+    dz=1) to ncol columns of length nz
+    """
+    key = (stencil.__name__, nz)
+    
+    if key not in _stencil_matrices:
+        
+        D = stencil(np.eye(nz), 1.0)
+        _stencil_matrices[key] = sparse.csr_matrix(D)
+        
+    return sparse.kron(sparse.identity(ncol), _stencil_matrices[key], \
+    format='csr')
+    
+def rho_system(x, z, dz, g, b, rho_int, rho_max):
+    """
+    Residual for the diff. eq. governing rho (for a single radius), where I 
+    (the integral of rho from 0 to z) is included as an unknown.  This keeps 
+    the jacobian sparse.  x[0:nz] is rho and x[nz:] is I.  This gives:
+    
+        residual[0:nz] : The diff. eq. for rho.  The first element (which is
+            always zero) is replaced by the normalization I[-1] = rho_int
+        residual[nz:] : I - cumulative trapezoid integral of rho
+        
+    The residuals are normalized by rho_max and rho_int
+    """
+    nz = len(z)
+    rho = x[0:nz]
+    I = x[nz:]
+    
+    res_rho = (drho_dz(rho, dz) + g*rho + 2*b*rho*I)/rho_max
+    res_rho[0] = (I[-1] - rho_int)/rho_int
+    
+    res_I = np.zeros(nz)
+    res_I[0] = I[0]
+    res_I[1:] = I[1:] - I[0:-1] - 0.5*(z[1:] - z[0:-1])*(rho[1:] + rho[0:-1])
+    res_I /= rho_int
+    
+    return np.concatenate([res_rho, res_I])
+    
+def rho_jacobian(x, z, dz, g, b, rho_int, rho_max, full=True):
+    """
+    Sparse jacobian of rho_system with respect to x = [rho, I] 
+    (see rho_system).  If full is False, the dependence of the diff. eq. 
+    for rho on I is dropped (ie the diff. eq. is linearized with I held
+    fixed)
+    """
+    nz = len(z)
+    rho = x[0:nz]
+    I = x[nz:]
+    eq_rows = np.ones(nz)
+    eq_rows[0] = 0
+    
+    # Derivatives of the diff. eq. for rho
+    D1 = _block_stencil(drho_dz, nz, 1)
+    A = sparse.diags(eq_rows/dz, 0) * D1 \
+    + sparse.diags(eq_rows*(g + 2*b*I), 0)
+    B = sparse.lil_matrix((nz, nz))
+    
+    if full:
+        
+        B.setdiag(eq_rows*2*b*rho)
+        
+    # Normalization constraint: I[-1] = rho_int
+    B[0, nz-1] = rho_max/rho_int
+    
+    # Derivatives of the integral of rho
+    dz_half = np.zeros(nz)
+    dz_half[1:] = 0.5*(z[1:] - z[0:-1])
+    sub = sparse.diags(np.ones(nz-1), -1)
+    E = sparse.identity(nz) - sub
+    C = -sparse.diags(dz_half, 0) * (sparse.identity(nz) + sub)
+    
+    J = sparse.bmat([[A/rho_max, B/rho_max], [C/rho_int, E/rho_int]])
+    
+    return J.tocsc()
+    
 def cdfinv_z(z,rho):
     """
     Calculates the inverse of the cumulative distribution function for
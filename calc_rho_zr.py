@@ -22,46 +22,182 @@ __iversion__ = int(filter(str.isdigit,__version__))
 
 # ICgen packages
 import calc_rho
+import rho_cache
+import cluster_pool
 import isaac
+from ICglobal_settings import global_settings
 
 # External packages
+import atexit
 import copy as copier
+import hashlib
+import os
+import sys
+import logging
+from warnings import warn
 import numpy as np
 import cPickle as pickle
 import scipy.interpolate as interp
+import scipy.integrate as nInt
 from multiprocessing import Pool, cpu_count
 
 import pynbody
 SimArray = pynbody.array.SimArray
 
+logger = logging.getLogger('ICgen.calc_rho_zr')
+
+# -------------------------------------------------------------------
+# WORKER POOL
+# A single pool is kept alive between calls to rho_zr.  The settings are 
+# sent to each worker once (by the pool initializer) and tasks only carry
+# floats: (sigma [Msol/au^2], T [K], r [au], zmax [au] or None)
+# -------------------------------------------------------------------
+_pool = None
+_pool_n_proc = None
+_pool_settings = None
+_worker_settings = None
+
+def _init_worker(settings):
+    # Pool initializer.  Store the settings in the worker process
+    global _worker_settings
+    _worker_settings = settings
+    set_log_level(settings.rho_calc.log_level)
+
+def _run_rho_z(args, rho_guess=None):
+    # Runs rho_z in a worker process for args = (sigma, T, r, zmax)
+    sigma, T, r, zmax = args
+    sigma = SimArray([sigma], 'Msol au**-2')
+    T = SimArray([T], 'K')
+    r = SimArray([r], 'au')
+    
+    if zmax is not None:
+        
+        zmax = SimArray([zmax], 'au')
+    
+    return calc_rho.rho_z(sigma, T, r, _worker_settings, full_output=True, \
+    rho_guess=rho_guess, zmax=zmax)
+
 def multirun_rho(args):
-    # A wrapper for multiprocessing calls to rho_z (allows multiple args)
-    return calc_rho.rho_z(*args)
+    # A wrapper for multiprocessing calls to rho_z.  Returns rho as a plain 
+    # array (Msol/au^3) and the solver info
+    rho, z, info = _run_rho_z(args)
+    
+    return np.asarray(rho.in_units('Msol au**-3')), info
+
+def multirun_rho_chunk(arg_list):
+    # A wrapper for multiprocessing calls to rho_z over a chunk of 
+    # neighbouring radii.  Each radius is seeded with the solution at the 
+    # previous one
+    results = []
+    prev = None
+    
+    for args in arg_list:
+        
+        prev = _run_rho_z(args, rho_guess=prev)
+        rho, z, info = prev
+        results.append((np.asarray(rho.in_units('Msol au**-3')), info))
+        
+    return results
+
+def get_pool(settings):
+    """
+    Returns the worker pool used by rho_zr, creating it if needed.  The pool
+    is re-used between calls unless the number of processes 
+    (settings.rho_calc.n_proc, or cpu_count() if None) or the settings
+    change.  The settings are sent to each worker once, when it starts.
+    
+    If settings.rho_calc.distributed is True, a cluster_pool is used instead,
+    running n_proc processes on each of the nodes in 
+    global_settings['node_info']['nodelist'] (see cluster_pool.py)
+    """
+    global _pool, _pool_n_proc, _pool_settings
+    
+    n_proc = settings.rho_calc.n_proc
+    
+    if settings.rho_calc.distributed:
+        
+        n_nodes = len(global_settings['node_info']['nodelist'])
+        n_proc_total = n_nodes * (cpu_count() if n_proc is None else n_proc)
+    
+    else:
+        
+        if n_proc is None:
+            
+            n_proc = cpu_count()
+        
+        n_proc_total = n_proc
+    
+    settings_str = pickle.dumps(settings, 2)
+    
+    if (_pool is None) or (n_proc_total != _pool_n_proc) \
+    or (settings_str != _pool_settings):
+        
+        close_pool()
+        
+        if settings.rho_calc.distributed:
+            
+            _pool = cluster_pool.cluster_pool(n_proc=n_proc, \
+            initializer=_init_worker, initargs=(settings,))
+        
+        else:
+            
+            _pool = Pool(n_proc, initializer=_init_worker, \
+            initargs=(settings,))
+        
+        _pool_n_proc = n_proc_total
+        _pool_settings = settings_str
+    
+    return _pool
 
-def rho_zr(ICobj):
+def close_pool():
+    """
+    Shuts down the worker pool used by rho_zr (if there is one)
+    """
+    global _pool, _pool_n_proc, _pool_settings
+    
+    if _pool is not None:
+        
+        _pool.close()
+        _pool.join()
+    
+    _pool = None
+    _pool_n_proc = None
+    _pool_settings = None
+
+atexit.register(close_pool)
+
+def rho_zr(ICobj, full_output=False):
     """
     Iterates over calc_rho.py to calculate rho(z,r) on a grid of z and r
     values.
     
     Requires ICobj.sigma to be defined already
     
+    If settings.rho_calc.cache_dir is set, solutions are looked up in (and 
+    saved to) an on-disk cache (see rho_cache.py) and only radii not found in
+    the cache are calculated
+    
     * Arguments *
     
     ICobj - The initial conditions object for which rho will be calculated
     
+    full_output - If True, also return a dictionary of solver info (see
+    calc_rho.rho_z) with one entry per radius
+    
     * Output *
-    Returns dictionary containing:
-        dict['rho'] : 2D array, rho at all pairs of points (z,r)
-        dict['z']   : a 1D array of z points
-        dict['r']   : a 1D array of r points
+    Returns rho, z, r:
+        rho : 2D array, rho at all pairs of points (z,r)
+        z   : a 1D array of z points.  If settings.rho_calc.scale_z is set, 
+              a 2D array with the z points at each radius (shape nz, nr)
+        r   : a 1D array of r points
         
-    If output=filename, dictionary is pickled and saved to filename
+    If full_output is True, returns rho, z, r, info
     
     To be safe, keep all units in Msol and au
     """
-    n_proc = cpu_count()
     # Get what's need from the IC object
     settings = ICobj.settings
+    set_log_level(settings.rho_calc.log_level)
     
     # PARSE SETTINGS
     # Rho calculation parameters
@@ -83,30 +219,361 @@ def rho_zr(ICobj):
         settings.rho_calc.zmax = zmax
         
     # Initialize r,z, and rho
-    r = SimArray(np.linspace(rmin,rmax,nr), 'au')
+    r = radial_grid(ICobj, rmin, rmax, nr, settings.rho_calc.r_grid)
+    
+    if settings.rho_calc.scale_z is not None:
+        # Use a different z grid at every radius
+        zmax = z_extent(ICobj, r)
+        z = SimArray(np.zeros([nz,nr]), 'au')
+        
+        for i in range(nr):
+            
+            z[:,i] = np.linspace(0.0, float(zmax[i]), nz)
+        
+    else:
+        
+        zmax = None
+        z = SimArray(np.linspace(0.0, settings.rho_calc.zmax, nz), 'au')
+        
     rho = SimArray(np.zeros([nz,nr]), 'Msol au**-3')
+    info = {'niter': np.zeros(nr, dtype=int), 'residual': np.zeros(nr), \
+    'converged': np.zeros(nr, dtype=bool), 'time': np.zeros(nr), \
+    'method': np.array([''] * nr, dtype='|S12')}
+    # Radii which need to be calculated
+    todo = np.arange(nr)
+    
+    if settings.rho_calc.cache_dir is not None:
+        
+        cache = rho_cache.rho_cache(settings.rho_calc.cache_dir, \
+        settings.rho_calc.cache_size)
+        keys = []
+        
+        for i in range(nr):
+            
+            zmax_i = None if zmax is None else zmax[[i]]
+            key = cache.key(ICobj.sigma(r[[i]]), ICobj.T(r[[i]]), r[[i]], \
+            zmax_i, settings)
+            keys.append(key)
+            result = cache.get(key)
+            
+            if result is not None:
+                
+                rho[:,i] = result[0]
+                info['residual'][i] = result[1]
+                info['converged'][i] = True
+                info['method'][i] = 'cache'
+                
+        todo = np.array([i for i in range(nr) if not info['converged'][i]], \
+        dtype=int)
+        logger.info('Found rho(z) in cache for %d of %d radii', \
+        nr - len(todo), nr)
+        
+    if len(todo) > 0:
+        
+        zmax_todo = None if zmax is None else zmax[todo]
+        rho_todo, info_todo = _rho_zr_solve(ICobj, r[todo], zmax_todo)
+        rho[:,todo] = rho_todo.in_units(rho.units)
+        
+        for key in info:
+            
+            info[key][todo] = info_todo[key]
+            
+        # Analytic solutions and empty columns (rho = 0) are cheap, so don't
+        # bother caching them
+        solved = [i for i in todo if info['method'][i] not in \
+        ('star', 'self-gravity', 'empty')]
+        
+        if settings.rho_calc.cache_dir is not None:
+            # Only cache solutions that converged
+            for i in solved:
+                
+                if info['converged'][i]:
+                    
+                    cache.put(keys[i], rho[:,i], info['residual'][i])
+            
+            # Prune once for the whole batch
+            cache.prune()
+    
+    if not np.all(info['converged']):
+        
+        logger.warning('rho did not converge at %d of %d radii', \
+        (~info['converged']).sum(), nr)
+    
+    _log_summary(r, info)
+    
+    if full_output:
+        
+        return rho, z, r, info
+        
+    return rho, z, r
+
+def set_log_level(level):
+    """
+    Sets the level of the 'ICgen' logger used by calc_rho and calc_rho_zr, 
+    eg 'DEBUG' (everything, including every iteration at every radius), 
+    'INFO' (a summary of the rho calculation) or 'WARNING'.  If the logger 
+    has no handlers yet, one that prints to stdout is added
+    """
+    ICgen_logger = logging.getLogger('ICgen')
+    handlers = [handler for handler in ICgen_logger.handlers \
+    if not isinstance(handler, logging.NullHandler)]
+    
+    if len(handlers) == 0:
+        
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        ICgen_logger.addHandler(handler)
+    
+    ICgen_logger.setLevel(level)
 
-    # Set up arguments for multiprocessing
+def _log_summary(r, info):
+    """
+    Logs a table summarizing the solver info (see rho_zr) over all radii
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        
+        return
+    
+    nr = len(r)
+    lines = ['rho(z,r) solver summary for {0} radii:'.format(nr), \
+    '{0:12s} {1:>10s} {2:>10s} {3:>10s}'.format('', 'min', 'mean', 'max')]
+    
+    for key, label in (('niter', 'iterations'), ('residual', 'residual'), \
+    ('time', 'time (s)')):
+        
+        x = info[key]
+        lines.append('{0:12s} {1:10.3g} {2:10.3g} {3:10.3g}'.format(label, \
+        x.min(), x.mean(), x.max()))
+    
+    slowest = np.argmax(info['time'])
+    methods = ', '.join(['{0}: {1}'.format(method, \
+    (info['method'] == method).sum()) for method in np.unique(info['method'])])
+    lines.append('method used ({0})'.format(methods))
+    lines.append('converged at {0} of {1} radii.  Total solver time {2:.3g} s, '
+    'slowest at r = {3:.4g} {4}'.format(info['converged'].sum(), nr, \
+    info['time'].sum(), float(r[slowest]), r.units))
+    logger.info('\n'.join(lines))
+    
+def _rho_zr_solve(ICobj, r, zmax=None):
+    """
+    Calculates rho(z) at the radii r (see rho_zr), either with the block
+    solver or by running calc_rho.rho_z over r using multiprocessing.  zmax
+    is a SimArray of zmax at every r, or None (use settings.rho_calc.zmax)
+    
+    Returns rho (2D SimArray, shape (nz, len(r))) and a dictionary of solver
+    info (see calc_rho.rho_z)
+    """
+    settings = ICobj.settings
+    nz = settings.rho_calc.nz
+    nr = len(r)
+    
+    if settings.rho_calc.vectorized:
+        # Solve for all radii at once as a single block system
+        rho, z, info = calc_rho.rho_zr_block(ICobj.sigma(r), ICobj.T(r), r, \
+        settings, full_output=True, zmax=zmax)
+        
+        return rho, info
+        
+    rho = SimArray(np.zeros([nz,nr]), 'Msol au**-3')
+
+    # Set up arguments for multiprocessing.  Only floats are sent
+    # (strip_units returns a scalar for a single radius, eg when all others
+    # were found in the cache)
+    sigma = np.atleast_1d(isaac.strip_units(ICobj.sigma(r).in_units(\
+    'Msol au**-2')))
+    T = np.atleast_1d(isaac.strip_units(ICobj.T(r).in_units('K')))
+    r_au = np.atleast_1d(isaac.strip_units(r.in_units('au')))
+    
+    if zmax is not None:
+        
+        zmax = np.atleast_1d(isaac.strip_units(zmax.in_units('au')))
+        
     arg_list = []
+    
     for i in range(nr):
         
-        arg_list.append([ICobj.sigma(r[[i]]), ICobj.T(r[[i]]), r[[i]], settings])
+        zmax_i = None if zmax is None else float(zmax[i])
+        arg_list.append((float(sigma[i]), float(T[i]), float(r_au[i]), zmax_i))
 
     # Calculate rho using multiprocessing
-    pool = Pool(n_proc)
-    results = pool.map(multirun_rho, arg_list)
-    pool.close()
+    pool = get_pool(settings)
+    n_proc = _pool_n_proc
+    chunksize = settings.rho_calc.chunksize
+    
+    if settings.rho_calc.warm_start:
+        # Split the radii into contiguous chunks, one per process.  Within a
+        # chunk, radii are done in order, starting from the previous solution
+        chunks = np.array_split(np.arange(nr), min(n_proc, nr))
+        chunk_args = [[arg_list[i] for i in chunk] for chunk in chunks]
+        results = []
+        
+        for chunk_results in pool.map(multirun_rho_chunk, chunk_args, 1):
+            
+            results.extend(chunk_results)
+            
+    else:
+        
+        if chunksize is None:
+            # A few chunks per process, to balance the load
+            chunksize = max(1, int(np.ceil(nr/(4.0*n_proc))))
+        
+        results = pool.map(multirun_rho, arg_list, chunksize)
     
     # Extract results
+    info = {'niter': np.zeros(nr, dtype=int), 'residual': np.zeros(nr), \
+    'converged': np.zeros(nr, dtype=bool), 'time': np.zeros(nr), \
+    'method': np.array([''] * nr, dtype='|S12')}
+    
     for i in range(nr):
         
-        rho_vector, z = results[i]
+        rho_vector, info_i = results[i]
         rho[:,i] = rho_vector
+        
+        for key in info:
+            
+            info[key][i] = info_i[key]
     
-    # Convert to the units generated by calc_rho
-    rho.convert_units(rho_vector.units)
+    return rho, info
+
+def z_extent(ICobj, r):
+    """
+    Calculates the maximum z to calculate rho(z) at for each radius r when 
+    the z grid is scaled by the scale height (see settings.rho_calc.scale_z).
+    The scale height h(r) is estimated by calc_rho.scale_height.
     
-    return rho, z, r
+    zmax(r) = min(scale_z * h(r), settings.rho_calc.zmax)
+    
+    Where h can't be estimated (eg, where sigma = 0 and T is infinite), 
+    zmax(r) = settings.rho_calc.zmax
+    
+    Returns a 1D SimArray of zmax at r
+    """
+    settings = ICobj.settings
+    zmax = settings.rho_calc.zmax
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        
+        h = calc_rho.scale_height(ICobj.sigma(r), ICobj.T(r), r, settings)
+        
+    h = isaac.strip_units(h.in_units(zmax.units))
+    z_extent = settings.rho_calc.scale_z * h
+    # Mask non-finite values before comparing, so NaN doesn't warn
+    good = np.isfinite(z_extent)
+    good[good] = (z_extent[good] > 0)
+    z_extent[~good] = np.inf
+    z_extent = np.minimum(z_extent, float(zmax))
+    
+    return SimArray(z_extent, zmax.units)
+    
+def radial_grid(ICobj, rmin, rmax, nr, kind='linear'):
+    """
+    Generates the radial grid that rho(z,r) is calculated on.
+    
+    * Arguments *
+    
+    ICobj - The initial conditions object.  ICobj.sigma and ICobj.T must be
+    defined (only used for kind = 'adaptive')
+    
+    rmin, rmax - Radial range (SimArrays)
+    
+    nr - number of radial points
+    
+    kind - 'linear' or 'adaptive'.  For 'linear', r is uniformly spaced.  
+    For 'adaptive', the points are placed so that they are equally spaced in
+    the arc-length of the curves rho0(r)/max(rho0) and rho0/max(rho0)*ln(h)
+    (on a normalized r axis).  rho0 = sigma/(2h) is the midplane density
+    and h the scale height, estimated by calc_rho.scale_height.  Points 
+    then concentrate where rho changes fastest, ie at steep cutoffs in sigma
+    and at small r, while at least half of the points remain spread 
+    uniformly.
+    
+    * Output *
+    
+    r - 1D SimArray of radii, in au
+    """
+    rmin = isaac.match_units(rmin, 'au')[0]
+    rmax = isaac.match_units(rmax, 'au')[0]
+    
+    if kind == 'linear':
+        
+        return SimArray(np.linspace(rmin,rmax,nr), 'au')
+        
+    elif kind != 'adaptive':
+        
+        raise ValueError, 'Unrecognized rho_calc.r_grid {0}'.format(kind)
+        
+    # Estimate the midplane density and scale height on a fine, uniform grid
+    n_fine = 20*nr
+    r_fine = SimArray(np.linspace(rmin, rmax, n_fine), 'au')
+    x = np.linspace(0, 1, n_fine)
+    sigma = ICobj.sigma(r_fine)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        
+        h = isaac.strip_units(calc_rho.scale_height(sigma, ICobj.T(r_fine), \
+        r_fine, ICobj.settings))
+        rho0 = 0.5*isaac.strip_units(sigma)/h
+        lnh = np.log(h)
+        
+    rho0[~np.isfinite(rho0)] = 0.0
+    rho0 /= rho0.max()
+    lnh[~np.isfinite(lnh)] = 0.0
+    
+    # Derivatives w.r.t. the normalized radius
+    drho0 = np.gradient(rho0, x[1])
+    dlnh = rho0*np.gradient(lnh, x[1])
+    dlnh[~np.isfinite(dlnh)] = 0.0
+    # Monitor function: arc-length, plus a uniform part
+    monitor = np.sqrt(drho0**2 + dlnh**2)
+    monitor += max(monitor.mean(), 1.0)
+    # Smooth the monitor function over ~4 uniform grid spacings so that the
+    # grid spacing changes gradually (abrupt changes cause the splines to
+    # ring at the edges of cutoffs)
+    width = 80
+    kernel = np.ones(width)/width
+    monitor = np.convolve(np.pad(monitor, width, 'edge'), kernel, 'same')
+    monitor = monitor[width:-width]
+    
+    # Equidistribute the monitor function
+    arc = np.zeros(n_fine)
+    arc[1:] = np.cumsum(0.5*(monitor[1:] + monitor[0:-1])*np.diff(x))
+    x_out = np.interp(np.linspace(0, arc[-1], nr), arc, x)
+    x_out[[0, -1]] = [0.0, 1.0]
+    r = rmin + x_out*(rmax - rmin)
+    
+    return SimArray(r, 'au')
+    
+def _gradient(f, x, axis=-1):
+    """
+    Second order finite difference derivative of f with respect to x along
+    axis, where x may be non-uniformly spaced (1D array).  Uses one-sided
+    first order differences at the ends, like np.gradient
+    """
+    f = np.rollaxis(np.asarray(f, dtype=float), axis, f.ndim)
+    x = np.asarray(x, dtype=float)
+    df = np.zeros(f.shape)
+    h = np.diff(x)
+    h0 = h[0:-1]
+    h1 = h[1:]
+    # Interior points
+    df[...,1:-1] = (h0**2*f[...,2:] - h1**2*f[...,0:-2] \
+    + (h1**2 - h0**2)*f[...,1:-1])/(h0*h1*(h0 + h1))
+    # Edges
+    df[...,0] = (f[...,1] - f[...,0])/h[0]
+    df[...,-1] = (f[...,-1] - f[...,-2])/h[-1]
+    
+    return np.rollaxis(df, f.ndim-1, axis)
+    
+def _unit_ratio(x, units):
+    """
+    Returns the factor to convert x to units.  If x has no units, it is 
+    assumed to be in units already (returns 1)
+    """
+    if pynbody.units.has_units(x):
+        
+        return x.units.ratio(units)
+    
+    return 1.0
 
 class rho_from_array:
     """
@@ -115,7 +582,12 @@ class rho_from_array:
     Upon initialization:
     Take 2D array rho(z,r) on the grid defined by the 1D arrays z and r and 
     create a 2D spline interpolation.  Points outside of z,r are taken to be
-    zero.  Also calculates the inverse CDF for rho(z) at all r points.
+    zero.  Also tabulates the inverse CDF for rho(z) at all r points.
+    
+    z can also be a 2D array (same shape as rho) if each radius has its own
+    z grid, scaled to the local scale height (see settings.rho_calc.scale_z).
+    The z grids must all be linspace(0, zmax(r), nz).  Everything is then
+    stored and interpolated in the normalized coordinate z/zmax(r)
     
     USAGE:
     
@@ -132,53 +604,145 @@ class rho_from_array:
     rho.save(filename):     saves rho to filename
     rho.save():             saves rho to filename defined in ICobj.settings
     
+    The splines and the inverse CDF table are built the first time they are
+    needed, so creating a rho object (eg when loading ICs) is cheap
     """
+    # Lazily built attributes and the methods which build them
+    _lazy_attrs = {'_rho_spline': '_rho_spline_gen', \
+    '_cdf_inv_table': '_cdf_inv_gen', '_drho_dr': '_radial_derivative', \
+    '_drho_dr_binned': '_drho_dr_binned_gen'}
     
     def __init__(self, ICobj, rho, z, r):
         """
         Initialize
         """
         self._parent = ICobj
-        self._rho_spline = interp.RectBivariateSpline(z,r,rho)
         self.rho_binned = rho
         self.r_bins = r
         self.z_bins = z
         
-        # Generate inverse cdf spline (used by cdf_inv)
-        self._cdf_inv_gen(rho, z, r)
-        # Generate radial derivative of rho (used by drho_dr)
-        self._radial_derivative()
+        if np.ndim(z) == 2:
+            # z is scaled differently at every radius
+            self._z_scale = z[-1]
+            zeta = np.linspace(0.0, 1.0, z.shape[0])
+            
+        else:
+            
+            self._z_scale = None
+            zeta = z
+            
+        self._zeta_bins = zeta
+        # The splines and the inverse CDF table are built when first used
+        # (see __getattr__)
+        
+    def __getattr__(self, attr):
+        """
+        Builds the splines and inverse CDF table on first access.  They are
+        then stored as normal attributes, so this is only called once for 
+        each
+        """
+        if attr not in self._lazy_attrs:
         
+            raise AttributeError(attr)
+        
+        getattr(self, self._lazy_attrs[attr])()
+        
+        return self.__dict__[attr]
         
     def __call__(self,z,r):
         
         return self.rho(z,r)
+        
+    def _zeta(self, z, r):
+        """
+        Returns the normalized z coordinate used by the splines, z/zmax(r).
+        z and r should already be in the units of z_bins and r_bins.  If z is
+        not scaled (ie z_bins is 1D), z is returned unchanged
+        """
+        if self._z_scale is None:
+            
+            return z
+        
+        return np.asarray(z)/self._zmax(r)
+        
+    def _zmax(self, r):
+        """
+        Returns zmax(r) (unitless, units of z_bins) for a scaled z grid.  r
+        should be in the units of r_bins
+        """
+        return np.interp(np.asarray(r, dtype=float), \
+        np.asarray(self.r_bins, dtype=float), \
+        np.asarray(self._z_scale, dtype=float))
     
-    def _cdf_inv_gen(self, rho, z, r):
+    def _rho_spline_gen(self):
+        """
+        Generate the spline for rho (used by rho)
+        """
+        self._rho_spline = interp.RectBivariateSpline(self._zeta_bins, \
+        self.r_bins, self.rho_binned)
+    
+    def _cdf_inv_gen(self):
+        """
+        Tabulates the inverse CDF of rho(z) at every r on a shared, uniform
+        grid of m (the CDF), giving a contiguous (nm, nr) table of z 
+        quantiles.  nm is set by settings.rho_calc.nm.  Used by cdf_inv 
+        (bilinear interpolation in m and r)
+        """
+        nm = self._parent.settings.rho_calc.nm
+        z = np.asarray(self._zeta_bins, dtype=float)
+        rho = np.asarray(self.rho_binned, dtype=float)
+        r = self.r_bins
+        # Calculate the (un-normalized) CDF at all r
+        f = np.zeros(rho.shape)
+        f[1:] = nInt.cumtrapz(rho, z, axis=0)
+        m_grid = np.linspace(0.0, 1.0, nm)
+        table = np.zeros([nm, len(r)])
         
-        cdf_inv = []
-        # Generate the inverse CDF
         for n in range(len(r)):
             
-            cdf_inv.append(calc_rho.cdfinv_z(z,rho[:,n]))
+            f_n = f[:,n]
+        
+            if f_n[-1] <= 0.0:
+                # The density (rho) is zero here for all z or neg or 
+                # something.  Make all particles go to z = 0.0
+                continue
+            
+            # Force the CDF to be monotonic and drop values where it is 
+            # constant (ie, prob = 0)
+            f_n = np.maximum.accumulate(f_n/f_n[-1])
+            keep = np.ones(len(f_n), dtype=bool)
+            keep[1:] = np.diff(f_n) > 0
+            table[:,n] = np.interp(m_grid, f_n[keep], z[keep])
         
-        self._cdf_inv = cdf_inv
+        self._cdf_inv_table = table
         
     def _radial_derivative(self):
         """
-        Generate the radial derivative of rho
+        Generate the spline for the radial derivative of rho (used by 
+        drho_dr)
+        """
+        self._drho_dr = interp.RectBivariateSpline(self._zeta_bins, \
+        self.r_bins, self._drho_dr_binned)
+    
+    def _drho_dr_binned_gen(self):
+        """
+        Calculate the radial derivative of rho on the z, r grid
         """
-        z = self.z_bins
+        zeta = self._zeta_bins
         r = self.r_bins
         rho = self.rho_binned
         
-        dz = z[[1]] - z[[0]]
-        dr = r[[1]] - r[[0]]
+        # r may be non-uniformly spaced
+        drho_dr_binned = _gradient(rho, r, axis=1)
         
-        drho_dr_binned = np.gradient(rho, dz, dr)[1]
-        
-        drho_dr_spline = interp.RectBivariateSpline(z, r, drho_dr_binned)
-        self._drho_dr = drho_dr_spline
+        if self._z_scale is not None:
+            # Derivative at constant z (rather than constant z/zmax(r))
+            z_scale = isaac.strip_units(self._z_scale)
+            dlnscale_dr = _gradient(z_scale, r)/z_scale
+            drho_dzeta = _gradient(rho, zeta, axis=0)
+            drho_dr_binned -= zeta[:,None] * dlnscale_dr[None,:] * drho_dzeta
+            
+        self._drho_dr_binned = np.asarray(drho_dr_binned, dtype=float)
         
         
 
@@ -219,28 +783,36 @@ class rho_from_array:
         r = isaac.match_units(r, runit)[0]
             
         # Initialize
-        n_pts = len(r)
         z_out = SimArray(np.zeros([len(r)]), zunit)
-        dr = self.r_bins[[1]] - self.r_bins[[0]]
-        r_indices = np.digitize(r, self.r_bins)
+        r_bins = np.asarray(self.r_bins, dtype=float)
+        r = np.asarray(r, dtype=float)
+        m = np.asarray(m, dtype=float)
         # Ignore values outside of the r range
-        mask = (r >= self.r_bins.min()) & (r < self.r_bins.max())
-        z = z_out[mask]
+        mask = (r >= r_bins.min()) & (r < r_bins.max())
         r = r[mask]
-        r_indices = r_indices[mask]
         m = m[mask]
         
-        # Loop through all used radial bins
-        used_indices = set(r_indices)        
-        for i in used_indices:
+        # Bilinear interpolation of the table in m (uniform) and r (bins may
+        # be non-uniform)
+        table = self._cdf_inv_table
+        nm, nr = table.shape
+        i = np.searchsorted(r_bins, r, side='right') - 1
+        i = np.clip(i, 0, nr-2)
+        t_r = (r - r_bins[i])/(r_bins[i+1] - r_bins[i])
+        m_ind = np.clip(m, 0.0, 1.0) * (nm-1)
+        j = np.clip(m_ind.astype(int), 0, nm-2)
+        t_m = m_ind - j
+        # Indices into the flattened table
+        flat = table.ravel()
+        ind = j*nr + i
+        z_lo = flat[ind] + t_m*(flat[ind+nr] - flat[ind])
+        ind += 1
+        z_hi = flat[ind] + t_m*(flat[ind+nr] - flat[ind])
+        z = z_lo + t_r*(z_hi - z_lo)
             
-            # Look at all particles in radial bin i
-            mask2 = (r_indices == i)
-            # Calculate z at the bin edges
-            z_lo = self._cdf_inv[i-1](m[mask2])
-            z_hi = self._cdf_inv[i](m[mask2])
-            # Linearly interpolate z from bin edges
-            z[mask2] = z_lo + ((z_hi-z_lo)/dr) * (r[mask2] - self.r_bins[[i-1]])
+        if self._z_scale is not None:
+            # The table gives z/zmax(r)
+            z *= self._zmax(r)
             
         # Assign z for all particles within the bin range
         z_out[mask] = z
@@ -248,42 +820,21 @@ class rho_from_array:
         return z_out
             
 
-    def rho(self,z,r):
+    def rho(self, z, r, chunksize=10**6):
         """
         A Callable method that works like a spline but handles units.
         
         returns rho(z,r), an N-D array evaluated over the N-D arrays z, r
-        """
         
-        # Fix up units
-        zunit = self.z_bins.units
-        runit = self.r_bins.units
+        Arrays are evaluated as scattered points (z[i], r[i]), in chunks of 
+        chunksize points.  float32 inputs give a float32 output (eg, for per-particle densities
+        of large snapshots).  See rho_from_array.ev
+        """
         rho_unit = self.rho_binned.units
         
-        z = isaac.match_units(z, zunit)[0]
-        r = isaac.match_units(r, runit)[0]
-        
-        if not hasattr(z, '__iter__'):
-            
-            rho_out = SimArray(self._rho_spline(z,r), rho_unit)
-            
-        else:
-            
-            rho_out = np.zeros(z.shape)
-            iterator = np.nditer([z,r], flags=['multi_index'])
-            
-            while not iterator.finished:
-                
-                z_val, r_val = iterator.value
-                ind = iterator.multi_index
-                rho_out[ind] = self._rho_spline(z_val, r_val)
-                iterator.iternext()
-                
-            rho_out = SimArray(rho_out, rho_unit)                
-                        
-        return rho_out
+        return SimArray(self.ev(z, r, chunksize=chunksize), rho_unit)
         
-    def drho_dr(self, z, r):
+    def drho_dr(self, z, r, chunksize=10**6):
         """
         Radial derivative of rho.  A callable method that works like a spline
         but handles units.
@@ -291,39 +842,48 @@ class rho_from_array:
         USAGE:
         
         drho_dr(z,r) returns the radial derivative of rho at z, r
+        
+        Arrays are evaluated in chunks (see rho_from_array.rho)
         """
+        drho_unit = self.rho_binned.units/self.r_bins.units
         
-        # Set-up units
-        zunit = self.z_bins.units
-        runit = self.r_bins.units
-        rho_unit = self.rho_binned.units
-        drho_unit = rho_unit/runit
+        return SimArray(self.ev(z, r, derivative=True, chunksize=chunksize), \
+        drho_unit)
         
-        # Put z, r in the correct units
-        z = isaac.match_units(z, zunit)[0]
-        r = isaac.match_units(r, runit)[0]
+    def ev(self, z, r, derivative=False, chunksize=10**6):
+        """
+        Evaluates rho (or drho_dr if derivative=True) at the scattered points
+        (z, r).  z and r are broadcast against each other.  If they have 
+        units, they are converted to the units of z_bins and r_bins, 
+        otherwise they are assumed to be in those units already.
         
-        # Iterate over drho        
-        if not hasattr(z, '__iter__'):
+        Points are evaluated chunksize at a time to limit the memory used by
+        temporary arrays.
             
-            drho = self._drho_dr(z,r)
-            
-        else:
-            
-            drho = np.zeros(z.shape)
-            iterator = np.nditer([z,r], flags=['multi_index'])
+        Returns a unitless array with the shape of the broadcast inputs 
+        (float32 if both inputs are float32, else float64)
+        """
+        spline = self._drho_dr if derivative else self._rho_spline
+        # Unit conversions are applied chunk by chunk to avoid copying z, r
+        z_ratio = _unit_ratio(z, self.z_bins.units)
+        r_ratio = _unit_ratio(r, self.r_bins.units)
+        z, r = np.broadcast_arrays(np.asarray(z), np.asarray(r))
+        dtype = np.result_type(z.dtype, r.dtype, np.float32)
+        shape = z.shape
+        z = z.ravel()
+        r = r.ravel()
+        out = np.zeros(len(z), dtype=dtype)
+        
+        for start in range(0, len(z), chunksize):
             
-            while not iterator.finished:
+            z_chunk = z_ratio * np.asarray(z[start:start + chunksize], \
+            dtype=float)
+            r_chunk = r_ratio * np.asarray(r[start:start + chunksize], \
+            dtype=float)
+            z_chunk = self._zeta(z_chunk, r_chunk)
+            out[start:start + chunksize] = spline.ev(z_chunk, r_chunk)
                 
-                z_val, r_val = iterator.value
-                ind = iterator.multi_index
-                drho[ind] = self._drho_dr(z_val, r_val)
-                iterator.iternext()
-                        
-        # Fix up units
-        drho = isaac.match_units(drho, drho_unit)[0]
-        
-        return drho
+        return out.reshape(shape)
 
     def copy(self):
         """
@@ -331,6 +891,95 @@ class rho_from_array:
         """
         return copier.copy(self)
         
+    def checksum(self):
+        """
+        Returns a checksum (sha1 hex string) of the rho grid (rho_binned, 
+        z_bins, r_bins, and their units) and settings.rho_calc.nm.  Used to
+        check that saved tables (see save_tables) belong to this rho
+        """
+        sha = hashlib.sha1()
+        
+        for x in (self.rho_binned, self.z_bins, self.r_bins):
+            
+            sha.update(np.ascontiguousarray(x, dtype=float).tostring())
+            sha.update(str(x.units))
+        
+        sha.update(repr(self._parent.settings.rho_calc.nm))
+        
+        return sha.hexdigest()
+    
+    def save_tables(self, prefix, root=None):
+        """
+        Saves the tabulated inverse CDF (prefix + 'cdf_inv.npy') and 
+        drho/dr grid (prefix + 'drho_dr.npy'), building them if needed.
+        
+        Returns a dictionary with the filenames and checksum, to be passed to
+        load_tables.  If root (a directory) is given, the filenames are 
+        stored relative to it, so the files can be moved along with root
+        """
+        tables = {'checksum': self.checksum()}
+        
+        for key, attr in (('cdf_inv', '_cdf_inv_table'), \
+        ('drho_dr', '_drho_dr_binned')):
+            
+            fname = '{0}{1}.npy'.format(prefix, key)
+            # Write to a temporary file then rename, since fname may be
+            # memory mapped by this rho (see load_tables)
+            tmpname = fname + '.tmp'
+            
+            with open(tmpname, 'wb') as f:
+                
+                np.save(f, np.asarray(getattr(self, attr)))
+            
+            os.rename(tmpname, fname)
+            
+            if root is not None:
+                
+                fname = os.path.relpath(fname, root)
+            
+            tables[key] = fname
+        
+        return tables
+    
+    def load_tables(self, tables, root=None):
+        """
+        Loads the tables saved by save_tables (as read-only memory maps) so 
+        that they don't need to be re-calculated.  tables is the dictionary
+        returned by save_tables, and root the directory the filenames are 
+        relative to (if save_tables was given one).  If the checksum doesn't
+        match this rho (or a file is missing), a warning is given and the 
+        tables are re-calculated when needed.
+        
+        Returns True if the tables were loaded
+        """
+        if tables.get('checksum') != self.checksum():
+            
+            warn('Saved rho tables do not match rho.  Ignoring them')
+            
+            return False
+        
+        if root is None:
+            
+            root = os.curdir
+        
+        try:
+            
+            cdf_inv = np.load(os.path.join(root, tables['cdf_inv']), \
+            mmap_mode='r')
+            drho_dr = np.load(os.path.join(root, tables['drho_dr']), \
+            mmap_mode='r')
+        
+        except (IOError, KeyError):
+            
+            warn('Could not load saved rho tables.  Ignoring them')
+            
+            return False
+        
+        self._cdf_inv_table = cdf_inv
+        self._drho_dr_binned = drho_dr
+        
+        return True
+    
     def save(self, filename = None):
         """
         Saves rho to filename.  If filename = None, tries to save to the 
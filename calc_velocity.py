@@ -162,10 +162,12 @@ max_particles=None, est_eps=True):
         m = np.zeros(nr)
         b = np.zeros(nr)    
         
+        order, bounds = ICgen_utils.bin_groups(ind, nr)
+        
         for i in range(nr):
             
-            mask = (ind == i)
-            p = np.polyfit(cos[mask], ar2[mask], 1)
+            group = order[bounds[i]:bounds[i+1]]
+            p = np.polyfit(cos[group], ar2[group], 1)
             m[i] = p[0]
             b[i] = p[1]
             
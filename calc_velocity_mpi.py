@@ -14,6 +14,7 @@ import pynbody
 SimArray = pynbody.array.SimArray
 
 import isaac
+import ICgen_utils
 
 import subprocess
 import os
@@ -134,10 +135,12 @@ def v_xy(f, param, changbin=None, nr=50, min_per_bin=100):
         m = np.zeros(nr)
         b = np.zeros(nr)    
         
+        order, bounds = ICgen_utils.bin_groups(ind, nr)
+        
         for i in range(nr):
             
-            mask = (ind == i)
-            p = np.polyfit(cos[mask], ar2[mask], 1)
+            group = order[bounds[i]:bounds[i+1]]
+            p = np.polyfit(cos[group], ar2[group], 1)
             m[i] = p[0]
             b[i] = p[1]
             
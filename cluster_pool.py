@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Defines a simple process pool which spreads work over several nodes of a
+cluster (eg, the nodes listed in global_settings['node_info']['nodelist'],
+see ICglobal_settings.py).
+
+A job server (a multiprocessing manager) is started on this machine and
+listens on a socket.  Worker processes are then launched on every node (via
+ssh, or as local processes for testing), connect to the server, run the
+initializer once and then pull chunks of tasks until the pool is closed.
+Tasks and results are sent as pickled strings, so the functions mapped must
+be importable (ie defined at the top level of an ICgen module).
+
+cluster_pool.map() behaves like multiprocessing.Pool.map(), so it can be used
+for any embarrassingly parallel step (eg, the per-radius rho(z) calculation
+in calc_rho_zr.py).
+
+USAGE:
+    
+    import cluster_pool
+    pool = cluster_pool.cluster_pool(['node1', 'node2'], n_proc=8)
+    results = pool.map(func, args, chunksize=10)
+    pool.close()
+
+To test locally, with 3 'nodes' on this machine:
+    
+    pool = cluster_pool.cluster_pool(['a', 'b', 'c'], launcher='local')
+
+NOTE: the nodes must see the same ICgen directory and python (eg over a
+shared file system) and must be able to connect to this machine.
+"""
+
+import os
+import sys
+import socket
+import subprocess
+import traceback
+import Queue
+import cPickle as pickle
+import numpy as np
+from multiprocessing import Process, cpu_count
+from multiprocessing.managers import BaseManager
+
+# ICgen modules
+from ICglobal_settings import global_settings
+
+_file = os.path.abspath(__file__)
+
+if _file.endswith('.pyc'):
+    
+    _file = _file[0:-1]
+
+_dir = os.path.dirname(_file)
+
+# Seconds to wait on the job server before checking whether to stop
+_poll_time = 1.0
+
+# -------------------------------------------------------------------
+# JOB SERVER
+# -------------------------------------------------------------------
+class _job_server(object):
+    """
+    Holds the task and result queues.  Lives in the server process, workers
+    access it through a proxy.  Everything passed in or out is a pickled
+    string, so the server never has to import the functions being mapped
+    """
+    def __init__(self, init_data):
+        
+        self.init_data = init_data
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+        self.stopped = False
+    
+    def get_init(self):
+        
+        return self.init_data
+    
+    def put_task(self, task):
+        
+        self.tasks.put(task)
+    
+    def get_task(self, timeout):
+        # Returns None once the pool has been stopped, or '' if there are no
+        # tasks (yet)
+        if self.stopped:
+            
+            return None
+        
+        try:
+            
+            return self.tasks.get(True, timeout)
+        
+        except Queue.Empty:
+            
+            return ''
+    
+    def put_result(self, result):
+        
+        self.results.put(result)
+    
+    def get_result(self, timeout):
+        # Returns None if no result arrives within timeout
+        try:
+            
+            return self.results.get(True, timeout)
+        
+        except Queue.Empty:
+            
+            return None
+    
+    def stop(self):
+        
+        self.stopped = True
+
+_job = None
+
+def _init_server(init_data):
+    # Initializer for the server process
+    global _job
+    _job = _job_server(init_data)
+
+def _get_job():
+    
+    return _job
+
+class _manager(BaseManager):
+    
+    pass
+
+_manager.register('get_job', callable=_get_job)
+
+# -------------------------------------------------------------------
+# WORKERS
+# -------------------------------------------------------------------
+def _worker(host, port, authkey):
+    """
+    Worker loop.  Connects to the job server at (host, port), runs the
+    initializer and then does tasks until the server stops
+    """
+    try:
+        
+        manager = _manager(address=(host, port), authkey=authkey)
+        manager.connect()
+        job = manager.get_job()
+        initializer, initargs = pickle.loads(job.get_init())
+    
+    except (IOError, EOFError):
+        # Server is gone
+        return
+    
+    if initializer is not None:
+        
+        initializer(*initargs)
+    
+    while True:
+        
+        try:
+            
+            task = job.get_task(_poll_time)
+        
+        except (IOError, EOFError):
+            
+            return
+        
+        if task is None:
+            
+            return
+        
+        if task == '':
+            
+            continue
+        
+        map_id, chunk_id, func, chunk = pickle.loads(task)
+        
+        try:
+            
+            result = (map_id, chunk_id, True, [func(x) for x in chunk])
+        
+        except Exception:
+            
+            result = (map_id, chunk_id, False, traceback.format_exc())
+        
+        try:
+            
+            job.put_result(pickle.dumps(result, 2))
+        
+        except (IOError, EOFError):
+            
+            return
+
+def _run_node(host, port, authkey, n_proc):
+    """
+    Runs n_proc worker processes on this node (n_proc = 0 uses all cpus) and
+    waits for them to finish
+    """
+    if n_proc <= 0:
+        
+        n_proc = cpu_count()
+    
+    procs = [Process(target=_worker, args=(host, port, authkey)) \
+    for i in range(n_proc)]
+    
+    for p in procs:
+        
+        p.start()
+    
+    for p in procs:
+        
+        p.join()
+
+# -------------------------------------------------------------------
+# POOL
+# -------------------------------------------------------------------
+class cluster_pool:
+    """
+    A pool of worker processes spread over several nodes.
+    
+    * Arguments *
+    
+    nodes - List of hostnames to run workers on.  If None, uses
+    global_settings['node_info']['nodelist']
+    
+    n_proc - Number of worker processes per node.  If None, all the cpus on
+    each node are used
+    
+    initializer, initargs - If initializer is not None, each worker calls
+    initializer(*initargs) once when it starts
+    
+    launcher - How to start workers.  'ssh' runs them on the nodes via ssh
+    (the local host is always started directly).  'local' starts every
+    'node' on this machine, which is useful for testing.  If None, uses
+    global_settings['node_info']['launcher'] (default 'ssh')
+    """
+    
+    def __init__(self, nodes=None, n_proc=None, initializer=None, \
+    initargs=(), launcher=None):
+        
+        node_info = global_settings['node_info']
+        
+        if nodes is None:
+            
+            nodes = node_info['nodelist']
+        
+        if launcher is None:
+            
+            launcher = node_info.get('launcher', 'ssh')
+        
+        if launcher not in ('ssh', 'local'):
+            
+            raise ValueError('Unrecognized launcher {0}'.format(launcher))
+        
+        self.nodes = list(nodes)
+        self.n_proc = n_proc
+        self._map_id = 0
+        
+        # Start the job server, listening on all interfaces
+        authkey = os.urandom(16).encode('hex')
+        init_data = pickle.dumps((initializer, initargs), 2)
+        self._manager = _manager(address=('', 0), authkey=authkey)
+        self._manager.start(_init_server, (init_data,))
+        self._job = self._manager.get_job()
+        port = self._manager.address[1]
+        hostname = socket.gethostname()
+        
+        # Launch workers
+        self._procs = []
+        n_arg = '0' if n_proc is None else str(int(n_proc))
+        worker_args = [_file, hostname, str(port), authkey, n_arg]
+        
+        for node in self.nodes:
+            
+            if (launcher == 'local') or (node == hostname):
+                
+                command = [sys.executable] + worker_args
+            
+            else:
+                
+                remote = 'cd {0} && {1} {2}'.format(_dir, sys.executable, \
+                ' '.join(worker_args))
+                command = ['ssh', node, remote]
+            
+            self._procs.append(subprocess.Popen(command, cwd=_dir))
+    
+    def map(self, func, iterable, chunksize=None):
+        """
+        Same as multiprocessing.Pool.map.  Applies func to every element of
+        iterable on the workers and returns a list of the results (in order).
+        Tasks are sent in chunks of chunksize (default 1)
+        """
+        items = list(iterable)
+        
+        if chunksize is None:
+            
+            chunksize = 1
+        
+        self._map_id += 1
+        n_chunks = int(np.ceil(len(items)/float(chunksize)))
+        
+        for i in range(n_chunks):
+            
+            chunk = items[i*chunksize:(i+1)*chunksize]
+            task = (self._map_id, i, func, chunk)
+            self._job.put_task(pickle.dumps(task, 2))
+        
+        results = [None] * n_chunks
+        n_done = 0
+        
+        while n_done < n_chunks:
+            
+            result = self._job.get_result(_poll_time)
+            
+            if result is None:
+                
+                if not self._alive():
+                    
+                    raise RuntimeError('All cluster_pool workers have exited')
+                
+                continue
+            
+            map_id, chunk_id, success, value = pickle.loads(result)
+            
+            if map_id != self._map_id:
+                # Left over from a failed map
+                continue
+            
+            if not success:
+                
+                raise RuntimeError('Task failed on cluster_pool worker:\n' \
+                + value)
+            
+            results[chunk_id] = value
+            n_done += 1
+        
+        return [x for chunk in results for x in chunk]
+    
+    def _alive(self):
+        
+        return any([p.poll() is None for p in self._procs])
+    
+    def close(self):
+        """
+        Stops the workers.  Call join() to wait for them to exit
+        """
+        self._job.stop()
+    
+    def join(self):
+        """
+        Waits for the workers to exit and shuts down the job server
+        """
+        for p in self._procs:
+            
+            p.wait()
+        
+        self._manager.shutdown()
+
+if __name__ == '__main__':
+    # Start the workers for a node.  Called by cluster_pool as:
+    #   python cluster_pool.py host port authkey n_proc
+    host, port, authkey, n_proc = sys.argv[1:5]
+    _run_node(host, int(port), authkey, int(n_proc))
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the cumulative sum used for the 'grid' spiral in
+pos_class._generate_theta gives exactly the same theta as the original
+python loop, theta[n+1] = theta[n] - dtheta[n], when generated all at once
+and in chunks, and compares their speed.
+
+Assumes ICgen is on the python path, eg from the ICgen directory:
+    
+    PYTHONPATH=. python example/check_grid_theta.py [nParticles]
+"""
+import sys
+import time
+import numpy as np
+
+import ICgen
+
+def theta_loop(r):
+    """
+    The original (reference) loop for the grid spiral
+    """
+    nParticles = len(r)
+    dtheta = np.sqrt(2*np.pi*(1 - r[0:-1]/r[1:]))
+    theta = np.zeros(nParticles)
+    
+    for n in range(nParticles - 1):
+        
+        theta[n+1] = theta[n] - dtheta[n]
+    
+    return theta
+
+def theta_chunks(pos, r, chunksize):
+    """
+    theta from pos._generate_theta, chunksize particles at a time
+    """
+    pos._last = None
+    theta = [pos._generate_theta(r[i0:i0 + chunksize], None) \
+    for i0 in range(0, len(r), chunksize)]
+    pos._last = None
+    
+    return np.concatenate(theta)
+
+if __name__ == '__main__':
+    
+    nParticles = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+    
+    IC = ICgen.IC(profile_kind='powerlaw')
+    IC.settings.rho_calc.nr = 100
+    IC.settings.rho_calc.nz = 200
+    IC.settings.pos_gen.nParticles = nParticles
+    IC.maker.sigma_gen()
+    IC.maker.rho_gen()
+    IC.maker.pos_gen(method='grid')
+    pos = IC.pos
+    r = np.asarray(pos.r)
+    
+    t0 = time.time()
+    theta_ref = theta_loop(r)
+    t_loop = time.time() - t0
+    
+    t0 = time.time()
+    theta = theta_chunks(pos, r, nParticles)
+    t_cumsum = time.time() - t0
+    
+    ok = np.array_equal(theta, theta_ref)
+    print 'All at once: identical = {0}'.format(ok)
+    
+    for chunksize in (1, 7, 1000, 12345):
+        
+        theta_c = theta_chunks(pos, r[0:10**5], chunksize)
+        same = np.array_equal(theta_c, theta_ref[0:10**5])
+        print 'Chunks of {0}: identical = {1}'.format(chunksize, same)
+        ok = ok and same
+    
+    print 'loop: {0:.3f} s, cumsum: {1:.3f} s ({2:.0f}x faster)'.format(\
+    t_loop, t_cumsum, t_loop/t_cumsum)
+    
+    if not ok:
+        
+        raise RuntimeError, 'grid theta does not match the reference loop'
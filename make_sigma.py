@@ -9,15 +9,14 @@ Created on Mon Jan 27 13:00:52 2014
 """
 # ICgen packages
 import isaac
+import ICgen_utils
 
 # External packages
 import pynbody
 SimArray = pynbody.array.SimArray
 
 import numpy as np
-from scipy.interpolate import interp1d
-from scipy.integrate import quad
-from scipy.integrate import simps
+from scipy.interpolate import make_interp_spline, PPoly
 import copy as copier
 
 class sigma_gen:
@@ -39,6 +38,26 @@ class sigma_gen:
     pdf = sigma.pdf(r)  # returns pdf evaluated at r
     cdf_inv = sigma.cdf_inv(m) # returns cdv_inv at m for 0 < m < 1
     
+    # The cubic splines for sigma and the pdf as piecewise polynomials (see
+    # scipy.interpolate.PPoly), with r in au and sigma in Msol/au^2.  These 
+    # have the coefficients and can be integrated/differentiated exactly.
+    # They don't extrapolate (they are NaN outside of r_bins)
+    
+    sigma.sigma_ppoly.c
+    sigma.pdf_ppoly.integrate(r1, r2)
+    dsigma_dr = sigma.sigma_ppoly.derivative()
+    
+    # Unit-free (faster) versions, with r in au and sigma in Msol/au^2
+    
+    sigma.sigma_raw(r)
+    sigma.pdf_raw(r)
+    sigma.cdf_inv_raw(m)
+    
+    # Draw radii, in chunks (see cdf_inv_sampler)
+    
+    for r in sigma.cdf_inv_sampler.sample(n, 'stratified', chunksize):
+        ...
+    
     # Generate sigma with a precalulated CDF (as done before)
     
     sigma = make_sigma.sigma_gen(r, sigma, CDF)
@@ -63,9 +82,9 @@ class sigma_gen:
         sigma(r) and assigns it to self.sigma
         
         Generates a spline interpolation of sigma vs r from the file
-        defined by settings.filenames.sigmaFileName.  Returns sigma vs r as
-        an cubic spline interpolation object
-        (see scipy.interpolation.interp1d)
+        defined by settings.filenames.sigmaFileName.  The cubic spline is
+        stored as a piecewise polynomial (see scipy.interpolate.PPoly) in
+        self.sigma_ppoly
         
         sigma_input should be a pickled dictionary with the entries:
         'sigma': <sigma evaluated at r>
@@ -78,10 +97,11 @@ class sigma_gen:
         sigmaBinned = isaac.match_units(sigmaBinned, 'Msol au**-2')[0]
         # Convert r_bins to default units of 'au'
         r_bins = isaac.match_units(r_bins, 'au')[0]
-        # Calculate spline interpolation
-        print 'Calculating spline interpolation (slow for many data points)'
-        sigspline = interp1d(r_bins,sigmaBinned,kind='cubic',fill_value=0.0,\
-        bounds_error=False)
+        # Calculate spline interpolation (the same cubic spline as 
+        # interp1d(kind='cubic')) and convert it to a piecewise polynomial
+        print 'Calculating spline interpolation'
+        sigspline = make_interp_spline(np.asarray(r_bins), \
+        np.asarray(sigmaBinned), k=3)
         
         def sigout(r):
             """
@@ -99,8 +119,9 @@ class sigma_gen:
             # Try to convert r to the units used to make sigspline ('au')
             r = isaac.match_units(r, 'au')[0]
             
-            return SimArray(sigspline(r), 'Msol au**-2')
+            return SimArray(self.sigma_raw(r), 'Msol au**-2')
         
+        self.sigma_ppoly = PPoly.from_spline(sigspline, extrapolate=False)
         self.sigma = sigout
         self.r_bins = r_bins
         
@@ -110,21 +131,17 @@ class sigma_gen:
         density) and returns it as a callable function pdf(r) to self.pdf
         pdf(r) = 2*pi*r*sigma(r), up to a normalization
         
-        Using sigma(r) calculated in _make_sigma and r_bins loaded from
-        settings.filenames.sigmaFileName, creates an interpolation over
-        r_bins, sigma(r_bins).  The PDF will be approximately normalized
+        The PDF is calculated exactly from the spline for sigma(r) as a 
+        piecewise polynomial (self.pdf_ppoly) and is normalized by its exact
+        integral
             
         """
             
-        # Calculate the binned PDF
-        pdfBinned = 2*np.pi*self.r_bins * self.sigma(self.r_bins)
-        # Normalize
-        integral = simps(pdfBinned,self.r_bins)
-        pdfBinned /= integral
-        # Calculate a spline interpolation
-        print 'Calculating spline interpolation (slow for many data points)'
-        pdfSpline = interp1d(self.r_bins, pdfBinned, kind='cubic',\
-        fill_value=0.0, bounds_error=False)
+        # 2*pi*r*sigma(r), normalized
+        pdf_ppoly = _times_r(self.sigma_ppoly)
+        x0, x1 = pdf_ppoly.x[[0, -1]]
+        pdf_ppoly.c *= 1.0/pdf_ppoly.integrate(x0, x1)
+        self.pdf_ppoly = pdf_ppoly
         
         def pdf_fcn(r_in):
             """
@@ -142,7 +159,7 @@ class sigma_gen:
             # Put r_in into the units used in generating the pdf
             r_in = isaac.match_units(r_in, self.r_bins)[0]
             # Evaluate the pdf at r_in
-            pdf_vals = pdfSpline(r_in)
+            pdf_vals = self.pdf_raw(r_in)
             # Put the pdf into units of r_in.units**-1
             pdf_vals = isaac.match_units(pdf_vals, 1/r_in)[0]
             
@@ -157,7 +174,8 @@ class sigma_gen:
         callable method and saves to self.cdf_inv
         
         The CDF_inv is made by cumulatively integrating the PDF over the radial
-        bins defined in self.r_bins
+        bins defined in self.r_bins.  The integral is calculated exactly, in
+        one pass, from the antiderivative of the PDF's piecewise polynomial
         
         The optional argument, f, is the CDF binned over the radial bins
             
@@ -166,34 +184,20 @@ class sigma_gen:
         # Calculate the CDF from prob
         r = self.r_bins
         r[0] = 0.0
-        nr = len(r)
         
         if f is None:
             
-            f = np.zeros(nr)
-            
-            for n in range(nr):
-                
-                f[n] = quad(self.pdf,r[[0]],r[[n]])[0]
-                
+            # Integrate the pdf.  The pdf is 0 outside of the spline's range
+            F = self.pdf_ppoly.antiderivative()
+            x0, x1 = self.pdf_ppoly.x[[0, -1]]
+            f = F(np.clip(np.asarray(r), x0, x1)) - F(x0)
             f /= f.max()
         
         self._CDF = f.copy()
         
         print 'calculating inverse CDF'
         # Calculate the inverse CDF.
-        # Assume CDF is approximately monotonic and sort to force it to be
-        ind = f.argsort()
-        f = f[ind]
-        r = r[ind]
-        # Drop values where CDF is constant (ie, prob = 0)
-        mask = np.ones(nr,dtype='bool')
-        for n in range(1,nr):
-            if f[n] == f[n-1]:
-                mask[n] = False
-        f = f[mask]
-        r = r[mask]
-        finv = interp1d(f,r,kind='linear')
+        self.cdf_inv_sampler = cdf_inv_sampler(f, r)
         
         def finv_fcn(m_in):
             """
@@ -210,23 +214,43 @@ class sigma_gen:
             Uses a linear spline interpolation.
             """
             
-            r_out = finv(m_in)
+            r_out = self.cdf_inv_sampler(m_in)
             r_out = isaac.match_units(r_out, r)[0]
             return r_out
         
         self.cdf_inv = finv_fcn
             
+    def sigma_raw(self, r):
+        """
+        Unit-free version of sigma(r), for speed.  r is in au (units are
+        ignored).  Returns sigma as a numpy array in Msol/au^2
+        """
+        return _ppoly_eval(self.sigma_ppoly, r)
+    
+    def pdf_raw(self, r):
+        """
+        Unit-free version of pdf(r), for speed.  r is in au (units are
+        ignored).  Returns the pdf as a numpy array in 1/au
+        """
+        return _ppoly_eval(self.pdf_ppoly, r)
+    
+    def cdf_inv_raw(self, m):
+        """
+        Unit-free version of cdf_inv(m), for speed.  Returns r as a numpy 
+        array in au
+        """
+        return self.cdf_inv_sampler(m)
+    
     def _disk_mass(self):
         """
-        Calculate the total disk mass by integrating sigma
+        Calculate the total disk mass by integrating sigma (exactly)
         """
-        # Assign variables
-        r = self.r_bins
-        sig = self.sigma(r)
-        # Now integrate
-        m_disk = simps(2*np.pi*r*sig, r)
-        m_units = sig.units * (r.units)**2
-        m_disk = isaac.match_units(m_disk, m_units)[0]
+        # Integrate 2*pi*r*sigma(r)
+        integrand = _times_r(self.sigma_ppoly)
+        x0, x1 = integrand.x[[0, -1]]
+        m_disk = 2*np.pi*integrand.integrate(x0, x1)
+        # sigma is in Msol/au^2 and r in au
+        m_disk = SimArray(m_disk, 'Msol')
         
         self.m_disk = m_disk
             
@@ -236,4 +260,199 @@ class sigma_gen:
         Returns a copy of the sigma object
         """
         return copier.copy(self)
-        
\ No newline at end of file
+
+class cdf_inv_sampler:
+    """
+    Inverse CDF (for inverse transform sampling) by linear interpolation of a 
+    tabulated CDF.  Gives the same results as np.interp(m, cdf, r) (and 
+    scipy's interp1d(cdf, r, kind='linear')), but the bins are found with a
+    guide table (the bin for each of nguide equal intervals in m) rather 
+    than a binary search, which is much faster.
+    
+    USAGE:
+    
+    sampler = cdf_inv_sampler(cdf, r)
+    r = sampler(m)  # 0 <= m <= 1
+    r = sampler(m, np.float32)  # float32 output
+    
+    # Draw n radii in chunks
+    for r in sampler.sample(n, kind, chunksize):
+        ...
+    
+    # Draw samples i0 to i1 (of n) only
+    r = next(sampler.sample(n, kind, start=i0, stop=i1))
+    
+    cdf is the CDF evaluated at r.  It is sorted and values where it is 
+    constant (ie, where the pdf is 0) are dropped, and stored in self.cdf and 
+    self.r.  Units are ignored.
+    """
+    
+    def __init__(self, cdf, r, nguide=None):
+        
+        cdf = np.asarray(cdf, dtype=float)
+        r = np.asarray(r, dtype=float)
+        # Assume CDF is approximately monotonic and sort to force it to be
+        ind = cdf.argsort()
+        cdf = cdf[ind]
+        r = r[ind]
+        # Drop values where CDF is constant (ie, prob = 0)
+        mask = np.ones(len(cdf), dtype=bool)
+        mask[1:] = (cdf[1:] != cdf[0:-1])
+        self.cdf = cdf = cdf[mask]
+        self.r = r = r[mask]
+        # Slope of r(cdf) in each bin.  The last is 0, so that r(cdf[-1]) is
+        # exactly r[-1]
+        self._slope = np.zeros(len(cdf))
+        self._slope[0:-1] = (r[1:] - r[0:-1])/(cdf[1:] - cdf[0:-1])
+        # cdf, with an extra value which m never reaches
+        self._cdf_ext = np.append(cdf, np.inf)
+        # Guide table: _guide[k] is the last bin edge with cdf <= k/nguide
+        if nguide is None:
+            
+            nguide = 16 * len(cdf)
+        
+        m_guide = np.arange(nguide + 1)/float(nguide)
+        self._guide = np.searchsorted(cdf, m_guide, side='right') - 1
+        # The first interval also holds any m < 0 (the cdf can be slightly 
+        # negative from round off)
+        self._guide[0] = 0
+        # Scale m by slightly less than nguide so that round off never puts
+        # m in a later interval
+        self._guide_scale = nguide * (1 - 1e-12)
+    
+    def __call__(self, m, dtype=None):
+        """
+        Evaluates the inverse CDF at m (0 <= m <= 1).  dtype (optional) is the
+        output dtype, eg np.float32 (the calculation is always done in 
+        float64).  Raises a ValueError if m is outside of the CDF's range (or
+        not finite)
+        """
+        m = np.asarray(m, dtype=float)
+        shape = m.shape
+        m = m.ravel()
+        cdf = self.cdf
+        r = self.r
+        
+        if m.size > 0 and ((not np.isfinite(m).all()) or (m.min() < cdf[0]) \
+        or (m.max() > cdf[-1])):
+            
+            raise ValueError, 'm is outside of the range of the CDF'
+        
+        # Find the last bin edge with cdf <= m by starting at the guide 
+        # table's and stepping up
+        cdf_ext = self._cdf_ext
+        lo = self._guide[(m * self._guide_scale).astype(np.intp)]
+        todo = np.nonzero(cdf_ext[lo + 1] <= m)[0]
+        
+        while len(todo) > 0:
+            
+            lo[todo] += 1
+            todo = todo[cdf_ext[lo[todo] + 1] <= m[todo]]
+        
+        # Linearly interpolate, the same way as np.interp
+        m = m - cdf[lo]
+        m *= self._slope[lo]
+        r_lo = r[lo]
+        
+        if dtype is None:
+            
+            dtype = float
+        
+        out = np.empty(m.shape, dtype=dtype)
+        np.add(m, r_lo, out=out)
+        
+        return out.reshape(shape)
+    
+    def sample(self, n, kind='stratified', chunksize=None, stream=None, \
+    dtype=None, start=0, stop=None):
+        """
+        A generator which draws n samples of r, chunksize (default all) at a 
+        time.  Yields r for each chunk.  kind sets how m is chosen:
+            
+            'grid' : evenly spaced, m = (i + 1)/(n + 1)
+            'stratified' : one random m in each of n equal bins, 
+                m = (i + u)/n.  Far less noisy than 'random'
+            'random' : uniform random m
+            'qmc' or 'halton' : the base 2 Halton sequence, m = point i + 1 
+                (see ICgen_utils.halton).  Scrambled if stream is given
+        
+        stream is the random number generator (eg np.random.RandomState) used
+        for 'stratified' and 'random' (default np.random), and to scramble 
+        'qmc'.  For 'qmc' stream is copied, not used, so the same stream gives
+        the same samples for any chunksize, start, and stop.  dtype is the 
+        output dtype (see __call__).  Only samples start to stop (default n) 
+        are drawn.
+        """
+        if stop is None:
+            
+            stop = n
+        
+        if chunksize is None:
+            
+            chunksize = max(stop - start, 1)
+        
+        scramble = None
+        
+        if stream is None:
+            
+            stream = np.random
+        
+        elif kind in ('qmc', 'halton'):
+            
+            scramble = copier.deepcopy(stream)
+        
+        for i0 in range(start, stop, chunksize):
+            
+            i1 = min(i0 + chunksize, stop)
+            
+            if kind == 'grid':
+                
+                m = np.arange(i0 + 1, i1 + 1) * (1.0/(n + 1))
+            
+            elif kind == 'stratified':
+                
+                m = (np.arange(i0, i1) + stream.rand(i1 - i0)) * (1.0/n)
+            
+            elif kind == 'random':
+                
+                m = stream.rand(i1 - i0)
+            
+            elif kind in ('qmc', 'halton'):
+                
+                # Point 0 of the sequence is m = 0 (unscrambled), so skip it
+                index = np.arange(i0 + 1, i1 + 1)
+                m = ICgen_utils.halton(index, 2, copier.deepcopy(scramble))
+            
+            else:
+                
+                raise ValueError, 'Unrecognized kind {0}'.format(kind)
+            
+            # Avoid m slightly > 1 from round off
+            np.clip(m, self.cdf[0], self.cdf[-1], out=m)
+            
+            yield self(m, dtype)
+
+def _ppoly_eval(ppoly, x):
+    """
+    Evaluates the piecewise polynomial ppoly at x (ignoring units), returning
+    0 outside of its range (rather than extrapolating or NaN)
+    """
+    x = np.asarray(x)
+    y = ppoly(x)
+    outside = (x < ppoly.x[0]) | (x > ppoly.x[-1])
+    
+    return np.where(outside, 0.0, y)
+
+def _times_r(ppoly):
+    """
+    Returns the piecewise polynomial r*ppoly(r), ie with one degree higher
+    """
+    c = ppoly.c
+    x = ppoly.x[0:-1]
+    c_out = np.zeros([c.shape[0] + 1, c.shape[1]])
+    # In each interval, r = x + t: t*p(t) raises the order of each 
+    # coefficient and x*p(t) doesn't
+    c_out[0:-1] += c
+    c_out[1:] += x * c
+    
+    return PPoly(c_out, ppoly.x, ppoly.extrapolate)
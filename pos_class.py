@@ -18,19 +18,33 @@ __iversion__ = int(filter(str.isdigit,__version__))
 import pynbody
 SimArray = pynbody.array.SimArray
 import numpy as np
+import hashlib
+from itertools import izip
+from multiprocessing import Pool
 
 # ICgen packages
-import isaac
 import ICgen_utils
 
+# The pos object being generated, for the worker processes (see 
+# pos.generate_chunks)
+_pos = None
+
+def _generate_chunk(bounds):
+    
+    return _pos._generate_chunk(*bounds)
+
 class pos:
     """
     position class.  Generates particle positions from rho and sigma
     
     USAGE:
-    # method = 'grid' or 'random'    
+    # method = 'grid', 'random' or 'qmc'    
     pos = pos_class.pos(ICobj, method)
     
+    'grid' places particles on a spiral, 'random' places them randomly and
+    'qmc' uses a (scrambled) quasi-random sequence, which has much less 
+    noise than 'random' without the spiral of 'grid'
+    
     ICobj should be an initial conditions object (ICgen.IC) with rho already
     calculated.
 
@@ -63,19 +77,120 @@ class pos:
             ICobj.settings.pos_gen.method = method
             
         self.nParticles = ICobj.settings.pos_gen.nParticles
+        
+        if not generate:
+            # Positions will be filled in later (eg by ICgen.load)
+            return
+        
         print 'Generating {0} particle positions using method: {1}'.format(\
         self.nParticles, self.method)
         
         # Generate positions
-        self._generate_r()
-        self.xyz = SimArray(np.zeros([self.nParticles, 3], dtype=np.float32), self.r.units)
-        self._generate_z()
-        self._generate_theta()
-        self._cartesian_pos()
+        for i0, i1 in self.generate_chunks():
+        
+            pass
+    
+    def generate_chunks(self, chunksize=None, n_proc=None):
+        """
+        Generates the positions chunk by chunk, writing them into self.r and
+        self.xyz.  Only one chunk of temporaries (random numbers, theta, etc)
+        is in memory at a time.  This is a generator: it yields (i0, i1) after
+        positions i0 to i1 have been generated.
+        
+        If chunksize is None, settings.pos_gen.chunksize is used (None means
+        all at once).  If settings.pos_gen.xyz_file is set, xyz is a memory
+        map to that file.
+        
+        Each chunk uses its own random streams for r, z, and theta (see 
+        pos._stream), so chunks are independent and can be generated by 
+        n_proc processes (default settings.pos_gen.n_proc).  The positions 
+        depend only on the seed and chunksize, not on n_proc.
+        """
+        settings = self._parent.settings.pos_gen
+        nParticles = self.nParticles
+        
+        if chunksize is None:
+            
+            chunksize = settings.chunksize
+        
+        if chunksize is None:
+            
+            chunksize = nParticles
         
-        # To save on memory, delete theta.  It can be re-calculated later
-        # if absolutely needed
-        del self.theta
+        if n_proc is None:
+            
+            n_proc = getattr(settings, 'n_proc', 1)
+        
+        xyz_file = getattr(settings, 'xyz_file', None)
+        
+        if self._seed is None:
+            
+            # Pick a seed (and keep it, so the positions can be regenerated)
+            self._seed = np.random.RandomState().randint(2**31)
+        
+        bounds = [(i0, min(i0 + chunksize, nParticles)) \
+        for i0 in range(0, nParticles, chunksize)]
+        pool = None
+        
+        if (n_proc > 1) and (len(bounds) > 1):
+            
+            # Build rho's inverse CDF table (see calc_rho_zr.rho_from_array)
+            # before forking so the workers needn't each build it
+            self._parent.rho._cdf_inv_table
+            # The workers get self when they're forked
+            global _pos
+            _pos = self
+            pool = Pool(n_proc)
+            chunks = pool.imap(_generate_chunk, bounds)
+        
+        else:
+            
+            chunks = (self._generate_chunk(i0, i1) for i0, i1 in bounds)
+        
+        # Last r and theta of the previous chunk (for method='grid')
+        self._last = None
+        
+        try:
+            
+            for (i0, i1), (r, z, theta) in izip(bounds, chunks):
+            
+                if i0 == 0:
+                
+                    # Allocate output
+                    self.r = SimArray(np.zeros(nParticles, dtype=np.float32), \
+                    r.units)
+                
+                    if xyz_file is None:
+                    
+                        xyz = np.zeros([nParticles, 3], dtype=np.float32)
+                
+                    else:
+                    
+                        xyz = np.memmap(xyz_file, dtype=np.float32, \
+                        mode='w+', shape=(nParticles, 3))
+                
+                    self.xyz = xyz.view(SimArray)
+                    self.xyz.units = r.units
+            
+                if theta is None:
+            
+                    # Grid spiral, which continues from the last chunk
+                    theta = self._generate_theta(r, None)
+                
+                self.r[i0:i1] = r
+                self.xyz[i0:i1, 2] = z
+                self._cartesian_pos(i0, i1, r, theta)
+                
+                yield i0, i1
+        
+        finally:
+            
+            if pool is not None:
+                
+                pool.terminate()
+                pool.join()
+        
+        del self._last
         
     def __getstate__(self):
         """
@@ -109,86 +224,143 @@ class pos:
         self.__dict__ = d
         
     
-    def _generate_r(self):
+    def _stream(self, component, i0):
         """
-        Generate radial positions
+        Returns the random number generator (a numpy RandomState) for 
+        component ('r', 'z', or 'theta') of the chunk starting at particle i0.
+        It is seeded by a hash of the seed, component and i0, so every 
+        component of every chunk gets an independent, reproducible stream
         """
+        key = '{0},{1},{2}'.format(self._seed, component, i0)
+        words = np.fromstring(hashlib.sha1(key).digest(), dtype=np.uint32)
         
-        print 'Generating r positions'
-        cdf_inv_r = self._parent.sigma.cdf_inv
-        
-        if self.method == 'grid':
-            
-            # Generate linearly increasing values of m, using 2 more than
-            # necessary to avoid boundary issues
-            m = np.linspace(0,1,self.nParticles + 2)
-            # Calculate r from inverse CDF
-            r = cdf_inv_r(m[1:-1]).astype(np.float32)
-            # Assign output
-            self.r = r
+        return np.random.RandomState(words)
+    
+    def _generate_chunk(self, i0, i1):
+        """
+        Generates r and z, and theta (for method='random' or 'qmc') for 
+        particles i0 to i1.  For method='grid' theta is None, since the spiral
+        depends on the previous chunks
+        """
+        if self.method == 'qmc':
             
+            return self._generate_qmc(i0, i1)
+        
+        r = self._generate_r(i0, i1, self._stream('r', i0))
+        z = self._generate_z(r, self._stream('z', i0))
+        theta = None
+        
         if self.method == 'random':
             
-            np.random.seed(self._seed)
-            m = np.random.rand(self.nParticles)
-            r = cdf_inv_r(m).astype(np.float32)
-            self.r = r
+            theta = self._generate_theta(r, self._stream('theta', i0))
+        
+        return r, z, theta
+    
+    def _generate_qmc(self, i0, i1):
+        """
+        Generates r, z, and theta for particles i0 to i1 from a scrambled 
+        Halton sequence (see ICgen_utils.halton), with one dimension for each
+        of r, z (including its sign) and theta.  Point n of the sequence is 
+        used for particle n, so the positions don't depend on chunksize
+        """
+        index = np.arange(i0 + 1, i1 + 1)
+        # Bases 2 (r), 3, and 5.  The scrambling is set by the seed
+        u_z, u_theta = [ICgen_utils.halton(index, base, \
+        self._stream('qmc{0}'.format(base), 0)) for base in (3, 5)]
+        # r
+        cdf_inv_r = self._parent.sigma.cdf_inv_sampler
+        r = next(cdf_inv_r.sample(self.nParticles, 'qmc', \
+        stream=self._stream('qmc2', 0), dtype=np.float32, start=i0, stop=i1))
+        r = SimArray(r, 'au')
+        # z.  The lower half of u_z gives z < 0 and the upper half z > 0
+        u_z *= 2
+        positive = (u_z >= 1)
+        u_z[positive] -= 1
+        z = self._parent.rho.cdf_inv(u_z, r)
+        z[~positive] *= -1
+        # theta
+        theta = 2*np.pi*u_theta
+        
+        return r, z, theta
+    
+    def _generate_r(self, i0, i1, stream):
+        """
+        Generate radial positions for particles i0 to i1.  stream is the 
+        random number generator (a numpy RandomState) to use
+        """
+        
+        # Unit-free inverse CDF, returns r in au
+        cdf_inv_r = self._parent.sigma.cdf_inv_sampler
+        
+        # 'grid' uses linearly increasing values of m, ie 
+        # linspace(0, 1, nParticles + 2)[1:-1], dropping the endpoints to 
+        # avoid boundary issues
+        r = next(cdf_inv_r.sample(self.nParticles, self.method, \
+        stream=stream, dtype=np.float32, start=i0, stop=i1))
             
-    def _generate_z(self):
+        return SimArray(r, 'au')
+    
+    def _generate_z(self, r, stream):
         """
-        Generate z positions
+        Generate z positions at radii r
         """
         
-        print 'Generating z positions'
         # The inverse CDF over z as a function of r
         cdf_inv_z = self._parent.rho.cdf_inv
         # Random numbers between 0 and 1
-        np.random.seed(self._seed)
-        m = np.random.rand(self.nParticles)
+        m = stream.rand(len(r))
         # Calculate z
-        z = cdf_inv_z(m, self.r)
+        z = cdf_inv_z(m, r)
         # Randomly select sign of z
-        z = z * np.random.choice(np.array([-1,1]), self.nParticles)
-        # Assign output
-        self.xyz[:,2] = z
+        z = z * stream.choice(np.array([-1,1]), len(r))
         
-    def _generate_theta(self):
+        return z
+    
+    def _generate_theta(self, r, stream):
         """
-        Generate angular positions
+        Generate angular positions at radii r
         """
         
-        nParticles = self.nParticles
+        nParticles = len(r)
         
         if self.method == 'grid':
             
-            r = self.r
+            # Continue the spiral from the end of the previous chunk
+            if self._last is not None:
+                
+                r_last, theta_last = self._last
+                r = np.concatenate((r_last, r))
             
             dtheta = np.sqrt(2*np.pi*(1 - r[0:-1]/r[1:]))
-            dtheta = isaac.strip_units(dtheta)
-            theta = np.zeros(nParticles)
+            # theta[n+1] = theta[n] - dtheta[n], as a cumulative sum.  
+            # np.cumsum adds in order (in float64), so this gives exactly the
+            # same theta as looping
+            steps = np.zeros(len(r))
             
-            for n in range(nParticles - 1):
+            if self._last is not None:
                 
-                # NOTE: it's import to subtract (not add) dtheta.  The particles
-                # will be moving counter-clockwise.  To prevent the particle
-                # spirals from kinking, the particle spirals must go out
-                # clockwise
-                theta[n+1] = theta[n] - dtheta[n]
+                steps[0] = theta_last
+            
+            # NOTE: it's import to subtract (not add) dtheta.  The particles
+            # will be moving counter-clockwise.  To prevent the particle
+            # spirals from kinking, the particle spirals must go out
+            # clockwise
+            steps[1:] = -np.asarray(dtheta)
+            theta = np.cumsum(steps)
                 
-            self.theta = theta
+            self._last = (r[-1:], theta[-1])
+            theta = theta[-nParticles:]
             
         if self.method == 'random':
             
-            np.random.seed(self._seed)
-            theta = 2*np.pi*np.random.rand(nParticles)
-            self.theta = theta
+            theta = 2*np.pi*stream.rand(nParticles)
             
-    def _cartesian_pos(self):
+        return theta
+    
+    def _cartesian_pos(self, i0, i1, r, theta):
         """
-        Generate x,y
+        Generate x,y for particles i0 to i1
         """
         
-        r = self.r
-        theta = self.theta
-        self.xyz[:,0] = r*np.cos(theta)
-        self.xyz[:,1] = r*np.sin(theta)
+        self.xyz[i0:i1,0] = r*np.cos(theta)
+        self.xyz[i0:i1,1] = r*np.sin(theta)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Defines a persistent, on-disk cache for rho(z) solutions (see calc_rho.rho_z)
+
+The solution at a given radius depends only on the local physical inputs
+(sigma, T, r), the star and molecular masses, the z grid (nz, zmax) and the
+numerical settings used by the solver.  These are hashed (sha1) to give a key,
+and each solution is stored as a .npy file named by its key, so that
+parameter sweeps (eg changing Qmin or nParticles) only recompute the radii
+whose inputs actually changed.
+
+Entries are read back as memory maps.  The total size of the cache is capped:
+when it grows too large, the least recently used entries are deleted by 
+prune(), which should be called after a batch of puts.
+
+USAGE:
+    
+    import rho_cache
+    cache = rho_cache.rho_cache('/path/to/cache', max_size=100)
+    key = cache.key(sigma, T, r, zmax, settings)
+    result = cache.get(key)
+    
+    if result is None:
+        
+        rho, z, info = calc_rho.rho_z(sigma, T, r, settings, full_output=True)
+        cache.put(key, rho, info['residual'])
+        cache.prune()
+    
+    else:
+        
+        rho, residual = result
+"""
+
+import os
+import hashlib
+import numpy as np
+
+import isaac
+
+# Bump this if the rho calculation changes, to invalidate old entries
+cache_version = 1
+
+class rho_cache:
+    """
+    A content-addressed, size-capped cache of rho(z) solutions.
+    
+    * Arguments *
+    
+    cache_dir - Directory to store the cache in.  Created if needed
+    
+    max_size - Maximum size of the cache in MB.  If None, the size is not
+    capped
+    
+    Each entry is a .npy file holding rho(z) (in Msol/au^3) followed by the
+    final residual of the solver
+    """
+    
+    def __init__(self, cache_dir, max_size=None):
+        
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        
+        if not os.path.isdir(self.cache_dir):
+            
+            os.makedirs(self.cache_dir)
+        
+        # max_size may have changed since the cache was last used
+        self.prune()
+    
+    def key(self, sigma, T, r, zmax, settings):
+        """
+        Generates the key for the solution at a radius.  sigma, T, r, and zmax
+        should be SimArrays (single elements).  zmax can be None, in which
+        case settings.rho_calc.zmax is used.  Also uses settings.physical (M,
+        m) and settings.rho_calc (nz, rho_tol, solver, vectorized)
+        
+        Returns a hex string
+        """
+        rho_calc = settings.rho_calc
+        
+        if zmax is None:
+            
+            zmax = rho_calc.zmax
+        
+        values = [float(isaac.strip_units(sigma.in_units('Msol au**-2'))), \
+        float(isaac.strip_units(T.in_units('K'))), \
+        float(isaac.strip_units(r.in_units('au'))), \
+        float(isaac.strip_units(zmax.in_units('au'))), \
+        float(isaac.strip_units(settings.physical.M.in_units('Msol'))), \
+        float(isaac.strip_units(settings.physical.m.in_units('m_p'))), \
+        rho_calc.nz, rho_calc.rho_tol, rho_calc.solver, \
+        rho_calc.vectorized, cache_version]
+        # repr gives the full precision of floats
+        key_str = ','.join([repr(val) for val in values])
+        
+        return hashlib.sha1(key_str).hexdigest()
+    
+    def _path(self, key):
+        
+        return os.path.join(self.cache_dir, key + '.npy')
+    
+    def get(self, key):
+        """
+        Retrieves an entry from the cache.  Returns (rho, residual), with
+        rho as a read-only memory map, or None if key is not in the cache
+        """
+        fname = self._path(key)
+        
+        try:
+            
+            data = np.load(fname, mmap_mode='r')
+        
+        except (IOError, ValueError):
+            # Not in the cache (or a corrupted entry)
+            return None
+        
+        # Mark as recently used
+        os.utime(fname, None)
+        
+        return data[0:-1], float(data[-1])
+    
+    def put(self, key, rho, residual):
+        """
+        Stores rho (1D array or SimArray in Msol/au^3) and the final residual
+        of the solver under key.  The cache is not pruned (prune lists the
+        whole cache), so call prune() once after a batch of puts
+        """
+        rho = isaac.strip_units(isaac.match_units(rho, 'Msol au**-3')[0])
+        data = np.append(np.asarray(rho, dtype=float), float(residual))
+        fname = self._path(key)
+        # Write to a temporary file then rename so that a partially written
+        # entry is never read
+        tmpname = '{0}.{1}.tmp'.format(fname, os.getpid())
+        
+        with open(tmpname, 'wb') as f:
+            
+            np.save(f, data)
+        
+        os.rename(tmpname, fname)
+    
+    def prune(self, max_size=None):
+        """
+        Deletes the least recently used entries until the cache is smaller
+        than max_size (in MB).  If max_size is None, self.max_size is used
+        """
+        if max_size is None:
+            
+            max_size = self.max_size
+        
+        if max_size is None:
+            
+            return
+        
+        entries = []
+        
+        for fname in os.listdir(self.cache_dir):
+            
+            if fname.endswith('.npy'):
+                
+                stat = os.stat(os.path.join(self.cache_dir, fname))
+                entries.append((stat.st_mtime, stat.st_size, fname))
+        
+        total = sum([entry[1] for entry in entries])
+        max_bytes = max_size * 1024.0**2
+        # Oldest first
+        entries.sort()
+        
+        for mtime, size, fname in entries:
+            
+            if total <= max_bytes:
+                
+                break
+            
+            try:
+                
+                os.remove(os.path.join(self.cache_dir, fname))
+            
+            except OSError:
+                # Another process may have removed it already
+                pass
+            
+            total -= size
+    
+    def clear(self):
+        """
+        Deletes all entries in the cache
+        """
+        self.prune(0)